@@ -0,0 +1,150 @@
+import argparse
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import model_registry
+import process
+from util import clean_and_sort, organize, process_wrist, resample
+
+"""
+Offline processing of a cohort, one process per subject.
+Each subject folder holds the aggregated wrist csv files
+(<subjects>/<subject>/<location>/Wrist/Aggregated/Accelerometer/Accelerometer.csv and Gyroscope/Gyroscope.csv),
+they are cleaned, resampled, written hour by hour as .npz columns like util.clean_and_resample organizes them,
+and the minute mets are estimated with the WRIST models. The input files are never rewritten.
+A subject is complete once its marker file is written, a rerun skips the complete subjects.
+
+    python batch.py /data/cohort --location Home --workers 8
+"""
+
+SENSORS = {'Accelerometer': ['Time', 'accX', 'accY', 'accZ'],
+           'Gyroscope': ['Time', 'rotX', 'rotY', 'rotZ']}
+DONE_FILE = 'batch_done.json'
+METS_FILE = 'mets.npz'
+
+
+def wrist_folder(root, subject, location):
+    return os.path.join(root, subject, location, 'Wrist')
+
+
+def aggregated_path(subjects_dir, subject, location, sensor):
+    return os.path.join(wrist_folder(subjects_dir, subject, location), 'Aggregated', sensor, sensor + '.csv')
+
+
+def find_subjects(subjects_dir, location):
+    """
+    Subject folders with both aggregated wrist files
+    :return: list
+        subject names, sorted
+    """
+    return sorted(subject for subject in os.listdir(subjects_dir)
+                  if all(os.path.isfile(aggregated_path(subjects_dir, subject, location, sensor)) for sensor in SENSORS))
+
+
+def is_done(output_dir, subject, location):
+    return os.path.isfile(os.path.join(wrist_folder(output_dir, subject, location), DONE_FILE))
+
+
+def process_subject(subjects_dir, subject, location, output_dir):
+    """
+    Clean, resample, organize and estimate the minute mets of one subject
+    :param subjects_dir: str
+        folder of the subject folders
+    :param subject: str
+        subject folder name
+    :param location: str
+        location folder of the subject, e.g. 'Home'
+    :param output_dir: str
+        folder the Clean hours, mets and marker are written to, laid out like subjects_dir
+    :return: int
+        number of minutes estimated
+    """
+    start = time.perf_counter()
+    wrist_data = []
+    for sensor, columns in SENSORS.items():
+        df = pd.read_csv(aggregated_path(subjects_dir, subject, location, sensor), usecols=[0, 1, 2, 3])
+        df.columns = columns
+        df = clean_and_sort(df)
+        df_resampled = resample(df, 'Time', 20, gapTolerance=500).dropna()
+
+        organize(df_resampled, output_dir, subject, sensor, location, resampled=True, columnar=True)
+        # the cleaned file goes through the same resampling as an upload
+        wrist_data.append(process_wrist(resample(df, 'Time', 20, 100)))
+        organize(df, output_dir, subject, sensor, location, columnar=True)
+
+    output_wrist_df = process.process_wrist_data(wrist_data, workers=1)
+    if not isinstance(output_wrist_df, pd.DataFrame):
+        raise ValueError('wrist data of {} could not be processed'.format(subject))
+
+    folder = wrist_folder(output_dir, subject, location)
+    np.savez(os.path.join(folder, METS_FILE), timestamp=np.asarray(output_wrist_df['timestamp'], dtype='datetime64[ns]'),
+             mets=np.asarray(output_wrist_df['mets'], dtype=float))
+    # written last, a subject interrupted before this point is processed again on the next run
+    with open(os.path.join(folder, DONE_FILE), 'w') as done:
+        json.dump({'minutes': len(output_wrist_df), 'models': model_registry.model_version(),
+                   'seconds': round(time.perf_counter() - start, 1)}, done)
+    return len(output_wrist_df)
+
+
+def run_batch(subjects_dir, location, output_dir=None, subjects=None, workers=None, force=False):
+    """
+    Process the subjects of a cohort in a process pool
+    :param subjects_dir: str
+        folder of the subject folders
+    :param location: str
+        location folder of each subject
+    :param output_dir: str
+        output folder, subjects_dir by default like util.clean_and_resample
+    :param subjects: list
+        subjects to process, every subject folder with wrist files by default
+    :param workers: int
+        processes, one subject at a time per process, all cores by default
+    :param force: bool
+        process the complete subjects again
+    :return: dict
+        subject -> error message of the subjects that failed
+    """
+    output_dir = output_dir or subjects_dir
+    subjects = subjects or find_subjects(subjects_dir, location)
+    pending = [subject for subject in subjects if force or not is_done(output_dir, subject, location)]
+    print("{} subjects, {} complete, {} to process".format(len(subjects), len(subjects) - len(pending), len(pending)))
+
+    failed = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=model_registry.load_models) as executor:
+        futures = {executor.submit(process_subject, subjects_dir, subject, location, output_dir): subject
+                   for subject in pending}
+        for future in as_completed(futures):
+            subject = futures[future]
+            try:
+                print("Done {}, {} minutes.".format(subject, future.result()))
+            except Exception as e:
+                traceback.print_exception(type(e), e, e.__traceback__)
+                print("error processing {}: {}".format(subject, e))
+                failed[subject] = str(e)
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Clean, resample and estimate the minute mets of a cohort")
+    parser.add_argument('subjects_dir', help="folder with one folder per subject")
+    parser.add_argument('--location', required=True, help="location folder of each subject, e.g. Home")
+    parser.add_argument('--output', help="output folder, the subjects folder by default")
+    parser.add_argument('--subjects', nargs='+', help="subjects to process, all by default")
+    parser.add_argument('--workers', type=int, help="subjects processed at once, the number of cores by default")
+    parser.add_argument('--force', action='store_true', help="process complete subjects again")
+    args = parser.parse_args(argv)
+
+    failed = run_batch(args.subjects_dir, args.location, args.output, args.subjects, args.workers, args.force)
+    if failed:
+        print("{} subjects failed: {}".format(len(failed), ', '.join(sorted(failed))))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
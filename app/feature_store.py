@@ -0,0 +1,123 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+"""
+Store of the per-minute features of each wrist recording.
+Features do not depend on the models, so a recording whose features are stored can be
+estimated again with new models without resampling or feature extraction.
+A recording is a directory of FEATURE_DIR holding one .npy file per feature, the least recently used
+recordings are removed once the directory is larger than FEATURE_MAX_BYTES.
+"""
+
+FEATURE_DIR = "./features"
+FEATURE_MAX_BYTES = int(os.environ.get("WRIST_FEATURE_MAX_BYTES", 1024 * 1024 * 1024))
+FEATURES = ['timestamp', 'intensity_freq', 'intensity_rmssd_l1', 'data_train']
+
+
+def recording_key(file_digests):
+    """
+    Key of a recording
+    :param file_digests: list
+        sha256 of each uploaded file, the order of the uploads does not matter
+    :return: str
+        hex key
+    """
+    return hashlib.sha256(','.join(sorted(file_digests)).encode()).hexdigest()
+
+
+def _path(recording):
+    return os.path.join(FEATURE_DIR, recording)
+
+
+def exists(recording):
+    """
+    Whether the features of a recording are stored
+    """
+    return os.path.isdir(_path(recording))
+
+
+def save(recording, minute_wrist, intensity_freq, intensity_rmssd_l1, data_train):
+    """
+    Store the features of every minute of a recording
+    :param recording: str
+        key from recording_key
+    :param minute_wrist: list
+        start time of each minute
+    :param intensity_freq: np.array
+        frequency intensity of each minute
+    :param intensity_rmssd_l1: np.array
+        l1 RMSSD intensity of each minute
+    :param data_train: np.array
+        (minutes, features) extract_features vectors
+    """
+    os.makedirs(FEATURE_DIR, exist_ok=True)
+    arrays = {'timestamp': np.asarray(pd.DatetimeIndex(minute_wrist), dtype='datetime64[ns]'),
+              'intensity_freq': np.asarray(intensity_freq),
+              'intensity_rmssd_l1': np.asarray(intensity_rmssd_l1),
+              'data_train': np.asarray(data_train)}
+    # written next to the store then renamed, a recording is either complete or missing
+    temp_dir = tempfile.mkdtemp(dir=FEATURE_DIR, suffix='.tmp')
+    try:
+        for name in FEATURES:
+            np.save(os.path.join(temp_dir, name + '.npy'), arrays[name], allow_pickle=False)
+        os.rename(temp_dir, _path(recording))
+    except OSError as e:
+        if not exists(recording):  # already stored by another job otherwise
+            print("error writing features: {}".format(e))
+        return
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    evict()
+
+
+def load(recording):
+    """
+    Stored features of a recording
+    :param recording: str
+        key from recording_key
+    :return: minute_wrist, intensity_freq, intensity_rmssd_l1, data_train
+        same values given to save, None if the recording is not stored
+    """
+    try:
+        arrays = {name: np.load(os.path.join(_path(recording), name + '.npy'), allow_pickle=False)
+                  for name in FEATURES}
+        os.utime(_path(recording))  # most recently used
+    except (OSError, ValueError):
+        return None
+    return (list(pd.DatetimeIndex(arrays['timestamp'])), arrays['intensity_freq'],
+            arrays['intensity_rmssd_l1'], arrays['data_train'])
+
+
+def recordings():
+    """
+    Keys of every stored recording
+    """
+    if not os.path.isdir(FEATURE_DIR):
+        return []
+    return sorted(name for name in os.listdir(FEATURE_DIR) if not name.endswith('.tmp'))
+
+
+def evict(max_bytes=FEATURE_MAX_BYTES):
+    """
+    Remove the least recently used recordings until the store fits in max_bytes
+    """
+    entries = []
+    for entry in os.scandir(FEATURE_DIR):
+        if entry.name.endswith('.tmp') or not entry.is_dir():
+            continue
+        try:
+            size = sum(file.stat().st_size for file in os.scandir(entry.path))
+            entries.append((entry.stat().st_mtime, size, entry.path))
+        except OSError:  # removed by another process
+            continue
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
@@ -0,0 +1,112 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from util import get_freq_intensity_batch, get_rmssd_batch, extract_features
+from segmentation import minute_array, assemble_windows
+
+"""
+Per-minute feature extraction of the wrist pipeline, serial or split across a process pool.
+No minute depends on another, so the recording is cut into chunks of contiguous minutes.
+The sensor samples are placed once in shared memory and every worker reads its minutes from there,
+only the row boundaries of the chunk and the small feature arrays go through the pool.
+"""
+
+# processes used for the feature extraction of one recording, 1 keeps it in the calling process
+FEATURE_WORKERS = int(os.environ.get("WRIST_FEATURE_WORKERS", 1))
+CHUNK_MINUTES = 60  # fewest minutes handed to a worker, smaller recordings are not split
+
+
+def minute_features(acc_values, acc_bounds, gyro_values, gyro_bounds, window_length=1200, acc_length=None):
+    """
+    Intensity and classification features of each minute
+    :param acc_values: np.array
+        (rows, 3) normalized accX, accY, accZ
+    :param acc_bounds: tuple
+        starts, ends rows of each minute in acc_values
+    :param gyro_values: np.array
+        (rows, 3) rotX, rotY, rotZ
+    :param gyro_bounds: tuple
+        starts, ends rows of each minute in gyro_values
+    :param window_length: int
+        samples per minute window given to the classification features
+    :param acc_length: int
+        samples per minute window given to the intensity features, None uses the longest minute
+    :return: intensity_freq, intensity_rmssd_l1, data_train: np.array
+        frequency intensity, l1 RMSSD intensity and classification features of each minute
+    """
+    # intensity features of all minutes at once
+    acc_windows = minute_array(acc_values, acc_bounds, length=acc_length)
+    intensity_freq = get_freq_intensity_batch(acc_windows, 100, 1)[:, 0]
+    intensity_rmssd_l1 = get_rmssd_batch(acc_windows, norm='l1')
+
+    # gyro then acc channels of every minute, short minutes are padded with 0
+    np_training = assemble_windows([(gyro_values, gyro_bounds), (acc_values, acc_bounds)], window_length)
+    data_train = extract_features(np_training)
+    return intensity_freq, intensity_rmssd_l1, data_train
+
+
+def parallel_minute_features(acc_values, acc_bounds, gyro_values, gyro_bounds, window_length=1200,
+                             workers=FEATURE_WORKERS, chunk_minutes=CHUNK_MINUTES, acc_length=None):
+    """
+    minute_features split over chunks of contiguous minutes, with the same bytes as the serial call
+    :param workers: int
+        number of processes, 1 computes everything here (callers already running in a process pool pass 1)
+    :param chunk_minutes: int
+        fewest minutes per chunk
+    :param acc_length: int
+        samples per minute window given to the intensity features, None uses the longest minute given
+    :return: intensity_freq, intensity_rmssd_l1, data_train: np.array
+        same as minute_features
+    """
+    acc_bounds = tuple(np.asarray(b) for b in acc_bounds)
+    gyro_bounds = tuple(np.asarray(b) for b in gyro_bounds)
+    n_minutes = len(acc_bounds[0])
+    if acc_length is None:
+        # the longest minute of the whole recording, so every chunk pads its windows alike
+        acc_length = int(np.max(acc_bounds[1] - acc_bounds[0], initial=0))
+
+    n_chunks = min(workers, n_minutes // max(chunk_minutes, 1))
+    if n_chunks <= 1:
+        return minute_features(acc_values, acc_bounds, gyro_values, gyro_bounds, window_length, acc_length)
+
+    cuts = np.linspace(0, n_minutes, n_chunks + 1).astype(int)
+    blocks = []
+    try:
+        acc = _share(np.ascontiguousarray(acc_values), blocks)
+        gyro = _share(np.ascontiguousarray(gyro_values), blocks)
+        with ProcessPoolExecutor(max_workers=n_chunks) as executor:
+            futures = [executor.submit(_chunk_features, acc, tuple(b[a:z] for b in acc_bounds),
+                                       gyro, tuple(b[a:z] for b in gyro_bounds), window_length, acc_length)
+                       for a, z in zip(cuts[:-1], cuts[1:])]
+            # merged in minute order
+            results = [future.result() for future in futures]
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return tuple(np.concatenate(parts) for parts in zip(*results))
+
+
+def _share(array, blocks):
+    # copy the array into a new shared memory block, described by (name, shape, dtype) for the workers
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    blocks.append(block)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block.name, array.shape, array.dtype.str
+
+
+def _chunk_features(acc, acc_bounds, gyro, gyro_bounds, window_length, acc_length):
+    # pool side of parallel_minute_features, reads the samples from shared memory without copying them
+    blocks = [shared_memory.SharedMemory(name=name) for name, _, _ in (acc, gyro)]
+    try:
+        acc_values, gyro_values = [np.ndarray(shape, dtype=dtype, buffer=block.buf)
+                                   for block, (_, shape, dtype) in zip(blocks, (acc, gyro))]
+        features = minute_features(acc_values, acc_bounds, gyro_values, gyro_bounds, window_length, acc_length)
+        # the results own their memory, nothing refers to the shared blocks once they are closed
+        features = tuple(np.array(feature) for feature in features)
+        del acc_values, gyro_values
+        return features
+    finally:
+        for block in blocks:
+            block.close()
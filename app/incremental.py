@@ -0,0 +1,224 @@
+import pickle
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from sqlalchemy import select
+from database import engine
+from models import WristSession, DEFAULT_SUBJECT, DEFAULT_SESSION
+from resampling import StreamingResampler
+from normalization import MinMaxStats, rescale_min_max
+from segmentation import sort_by_datetime, minute_starts, minute_bounds
+from ingest import SENSOR_COLUMNS, read_wrist_chunks, to_datetime, wrist_sensor
+import process
+
+"""
+Incremental processing of wrist data that keeps arriving for a session, e.g. a watch uploading every hour.
+The resamplers and the samples of the trailing partial minute are kept per subject and session between
+uploads, so each upload only resamples its own rows and estimates the minutes it completes, the new minutes
+are appended to the wrist table by jobs.run_append. The state is stored in the wrist_session table with a
+version, it is replaced in the same transaction as the rows it produced and only if no other upload
+replaced it meanwhile.
+The accelerometer is rescaled with the minimum/maximum of the session seen so far, the range of
+the whole recording is not known yet, so early minutes can differ from a single upload of all the data.
+"""
+
+
+class IncrementalWrist:
+    """
+    Resampling state and pending samples of one session
+
+    >>> state = IncrementalWrist()
+    >>> state.push('gyro', unixtimes, values)
+    >>> state.push('accel', unixtimes, values)
+    >>> new_minutes = state.estimate(state.complete_minutes())
+    """
+
+    def __init__(self):
+        self.sensors = {}
+        for sensor, columns in SENSOR_COLUMNS.items():
+            # resampled like the upload path, 20Hz with a 100ms gap tolerance then 20Hz
+            self.sensors[sensor] = {'upload': StreamingResampler(20, 100), 'process': StreamingResampler(20),
+                                    'unixtimes': np.array([], dtype=np.int64),
+                                    'values': np.empty((0, len(columns))),
+                                    'last_unixtime': None}
+        self.acc_stats = MinMaxStats(len(process.ACC_COLUMNS))
+        self.next_minute = None  # start of the first minute not estimated yet
+
+    def push(self, sensor, unixtimes, values):
+        """
+        Resample the next rows of a sensor
+        :param sensor: str
+            'accel' or 'gyro'
+        :param unixtimes: np.array
+            ascending unix ms, rows not after the last pushed row (e.g. an upload sent again) are skipped
+        :param values: np.array
+            (rows, 3) sensor values
+        """
+        state = self.sensors[sensor]
+        if state['last_unixtime'] is not None:
+            new = unixtimes > state['last_unixtime']
+            unixtimes, values = unixtimes[new], values[new]
+        if len(unixtimes) == 0:
+            return
+        state['last_unixtime'] = unixtimes[-1]
+
+        unixtimes, values = state['process'].push(*state['upload'].push(unixtimes, values))
+        state['unixtimes'] = np.concatenate([state['unixtimes'], unixtimes])
+        state['values'] = np.concatenate([state['values'], values])
+        if sensor == 'accel':
+            self.acc_stats.update(values)
+
+    def complete_minutes(self):
+        """
+        Minutes not estimated yet whose samples all arrived, from both sensors
+        :return: list
+            minute starts, consecutive
+        """
+        gyro = self.sensors['gyro']
+        if self.next_minute is None:
+            if len(gyro['unixtimes']) == 0:
+                return []
+            # the first gyroscope sample sets the first minute, like process_wrist_data
+            first = to_datetime(gyro['unixtimes'][:1])[0]
+            self.next_minute, _ = process.time_parameters(pd.DataFrame({'Datetime': [first, first]}))
+
+        if any(len(state['unixtimes']) == 0 for state in self.sensors.values()):
+            return []
+        # a minute is complete once both sensors have a sample at or after its end
+        last = min(to_datetime(state['unixtimes'][-1:])[0] for state in self.sensors.values())
+        if last < self.next_minute:
+            return []
+        n_minutes = int((last - self.next_minute) // pd.Timedelta(seconds=process.WINDOW_SIZE))
+        return list(minute_starts(self.next_minute, n_minutes))
+
+    def estimate(self, minute_wrist, workers=process.FEATURE_WORKERS):
+        """
+        Estimate complete minutes and drop their samples
+        :param minute_wrist: list
+            minutes from complete_minutes
+        :param workers: int
+            processes used for the feature extraction
+        :return: dataframe
+            minute met estimate, empty when there is no minute
+        """
+        if not minute_wrist:
+            return pd.DataFrame({'timestamp': pd.to_datetime([]), 'mets': np.array([], dtype=float)})
+
+        windows = {}
+        end = minute_wrist[-1] + pd.Timedelta(seconds=process.WINDOW_SIZE)
+        for sensor, state in self.sensors.items():
+            df = pd.DataFrame({'Time': state['unixtimes'], 'Datetime': to_datetime(state['unixtimes']),
+                               'row': np.arange(len(state['unixtimes']))})
+            df = sort_by_datetime(df)
+            values = state['values'][df['row'].values]
+            windows[sensor] = (values, minute_bounds(df, minute_wrist[0], len(minute_wrist), process.WINDOW_SIZE))
+            # samples of the trailing partial minute wait for the next upload
+            kept = np.asarray(df['Datetime'] >= end)
+            state['unixtimes'] = np.asarray(df['Time'])[kept]
+            state['values'] = values[kept]
+        self.next_minute = end
+
+        acc_values, acc_bounds = windows['accel']
+        acc_values = np.array(acc_values, dtype=float, order='C')
+        rescale_min_max(acc_values, self.acc_stats.minimum, self.acc_stats.maximum,
+                        process.ACC_TARGET_MAX, process.ACC_TARGET_MIN)
+        gyro_values, gyro_bounds = windows['gyro']
+        return process.estimate_minutes(minute_wrist, acc_values, acc_bounds, gyro_values, gyro_bounds, workers)
+
+
+def read_upload(wrist_files):
+    """
+    Rows of the uploaded wrist csv files
+    :param wrist_files: list
+        accelerometer and/or gyroscope csv file objects or paths
+    :return: list
+        (sensor, unixtimes, values) per chunk, None if a file is not a wrist csv
+    """
+    chunks = []
+    for wrist_file in wrist_files:
+        try:
+            sensor = wrist_sensor(wrist_file)
+            if sensor is None:
+                print("error in data frame columns")
+                return None
+            for unixtimes, values in read_wrist_chunks(wrist_file, SENSOR_COLUMNS[sensor]):
+                chunks.append((sensor, unixtimes, values))
+        except ValueError as e:  # unparsable csv, e.g. a column that is not numeric
+            print("error reading wrist csv: {}".format(e))
+            return None
+    return chunks
+
+
+def push_files(state, wrist_files):
+    """
+    Add the rows of an upload to the state, nothing is added when a file is not a wrist csv
+    :param state: IncrementalWrist
+        state of the session
+    :param wrist_files: list
+        accelerometer and/or gyroscope csv files with the rows recorded since the previous upload
+    :return: bool
+        False if a file is not a wrist csv
+    """
+    chunks = read_upload(wrist_files)
+    if chunks is None:
+        return False
+    for sensor, unixtimes, values in chunks:
+        state.push(sensor, unixtimes, values)
+    return True
+
+
+def load_state(subject=DEFAULT_SUBJECT, session=DEFAULT_SESSION):
+    """
+    Stored state of a session
+    :param subject, session: str
+        keys of the state
+    :return: state, version
+        IncrementalWrist and the version to give to save_state, a new state and None if none is stored
+    """
+    table = WristSession.__table__
+    with engine.connect() as connection:
+        row = connection.execute(select([table.c.state, table.c.version])
+                                 .where(table.c.subject == subject).where(table.c.session == session)).fetchone()
+    if row is None:
+        return IncrementalWrist(), None
+    return pickle.loads(row['state']), row['version']
+
+
+def save_state(connection, state, subject, session, version):
+    """
+    Store the state of a session if it is still at version, part of the caller's transaction
+    :param state: IncrementalWrist
+        new state
+    :param subject, session: str
+        keys of the state
+    :param version: int
+        version from load_state, None for a session without stored state
+    :return: bool
+        False if another upload stored a state since version was read
+    """
+    table = WristSession.__table__
+    values = {'state': pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL),
+              'next_minute': None if state.next_minute is None else state.next_minute.to_pydatetime(),
+              'updated': datetime.now()}
+    if version is None:
+        result = connection.execute(table.insert().prefix_with('OR IGNORE').values(
+            subject=subject, session=session, version=1, **values))
+    else:
+        result = connection.execute(table.update().where(table.c.subject == subject)
+                                    .where(table.c.session == session).where(table.c.version == version)
+                                    .values(version=version + 1, **values))
+    return result.rowcount == 1
+
+
+def reset_sessions(connection, subject=None, session=None):
+    """
+    Forget the incremental state, part of the caller's transaction (connection or orm session)
+    :param subject, session: str
+        subject and/or session to reset, every state by default
+    """
+    statement = WristSession.__table__.delete()
+    if subject is not None:
+        statement = statement.where(WristSession.subject == subject)
+    if session is not None:
+        statement = statement.where(WristSession.session == session)
+    connection.execute(statement)
@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+from resampling import StreamingResampler
+from segmentation import stream_minutes
+from normalization import MinMaxStats
+
+"""
+Chunked reading of wrist csv uploads
+"""
+
+CHUNK_SIZE = 200000  # csv rows read at a time
+SENSOR_COLUMNS = {'accel': ['accX', 'accY', 'accZ'],
+                  'gyro': ['rotX', 'rotY', 'rotZ']}
+
+
+def wrist_sensor(file):
+    """
+    Find which sensor a wrist csv holds from its header
+    :param file: file object or path
+        uploaded csv, a file object is rewound after reading the header
+    :return: str
+        'accel', 'gyro' or None
+    """
+    columns = pd.read_csv(file, nrows=0).columns
+    if hasattr(file, 'seek'):
+        file.seek(0)
+    for sensor, sensor_columns in SENSOR_COLUMNS.items():
+        if sensor_columns[0] in columns:
+            return sensor
+    return None
+
+
+def read_wrist_chunks(file, columns, chunksize=CHUNK_SIZE):
+    """
+    Read a wrist csv in chunks with explicit dtypes
+    :param file: file object or path
+        csv with a Time column (unix ms) and the sensor columns
+    :param columns: list
+        sensor columns to read
+    :param chunksize: int
+        rows per chunk
+    :return: generator
+        (unixtimes, (rows, channels) values) per chunk
+    """
+    dtypes = {'Time': np.int64}
+    dtypes.update({column: np.float64 for column in columns})
+    for chunk in pd.read_csv(file, usecols=['Time'] + columns, dtype=dtypes, chunksize=chunksize):
+        yield chunk['Time'].values, chunk[columns].values
+
+
+def rewind(file):
+    """
+    Read a file object again from its start, a path is opened again by pandas
+    """
+    if hasattr(file, 'seek'):
+        file.seek(0)
+    return file
+
+
+def to_datetime(unixtimes):
+    """
+    Local datetime of unix ms timestamps, same as util.process_wrist
+    """
+    return pd.to_datetime(unixtimes, unit='ms', utc=True).tz_convert('America/Chicago').tz_localize(None)
+
+
+class WristStream:
+    """
+    Minute windows of a wrist csv, read in chunks and resampled like the upload path does
+    (20Hz with a 100ms gap tolerance in main.process_wrist, then 20Hz in process_wrist_data).
+    Iterating yields (minute start, (samples, channels) values) as each minute completes, so only
+    one chunk and one partial minute are held at a time. The first and last Datetime and the
+    column minimum/maximum of the resampled data are available once the stream is consumed.
+    """
+
+    def __init__(self, file, columns, chunksize=CHUNK_SIZE):
+        self.file = file
+        self.columns = columns
+        self.chunksize = chunksize
+        self.first_datetime = None
+        self.last_datetime = None
+        self.stats = MinMaxStats(len(columns))
+
+    @property
+    def minimum(self):
+        return self.stats.minimum
+
+    @property
+    def maximum(self):
+        return self.stats.maximum
+
+    def __iter__(self):
+        return stream_minutes(self._datetime_chunks())
+
+    def scan(self):
+        """
+        Read the whole stream for its first and last Datetime and its minimum/maximum, no sample is kept
+        :return: WristStream
+            self
+        """
+        for _ in self._datetime_chunks():
+            pass
+        return self
+
+    def resampled_chunks(self):
+        """
+        Resampled (unixtimes, values) chunks
+        """
+        upload = StreamingResampler(20, 100)
+        process = StreamingResampler(20)
+        for unixtimes, values in read_wrist_chunks(self.file, self.columns, self.chunksize):
+            yield process.push(*upload.push(unixtimes, values))
+        yield process.push(*upload.finish())
+        yield process.finish()
+
+    def _datetime_chunks(self):
+        for unixtimes, values in self.resampled_chunks():
+            if len(unixtimes) == 0:
+                continue
+            datetimes = to_datetime(unixtimes)
+            if self.first_datetime is None:
+                self.first_datetime = datetimes[0]
+            self.last_datetime = datetimes[-1]
+            self.stats.update(values)
+            yield datetimes, values
@@ -0,0 +1,534 @@
+import json
+import os
+import shutil
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+import pandas as pd
+from database import SessionLocal, engine
+from models import Job, Wrist, DEFAULT_SUBJECT, DEFAULT_SESSION
+from persistence import insert_mets, bump_data_version
+import model_registry
+import process
+import result_cache
+import feature_store
+import incremental
+
+"""
+Persistent job queue for the CPU heavy wrist pipeline.
+Jobs are rows of the job table and their uploads are saved under JOB_DIR, a bounded
+process pool runs them outside the web worker. Jobs left unfinished by a restart
+are queued again when the app starts. A job belongs to a process identified by more than its pid
+(process_identity), so a pid reused after a container restart does not keep a job running forever.
+A pool broken by a dead process (e.g. killed when out of memory) is replaced on the next submit,
+its jobs are queued again.
+Uploads already processed with the same models are answered from the result cache, uploads whose
+features are stored only go through the models. Append jobs add the rows recorded since the previous
+upload of a session, through the incremental state of the session. A reinfer job estimates every stored recording again,
+e.g. after a model rollout, and replaces the rows of their jobs. A quick accelerometer only estimate can be stored
+as provisional rows while the job waits or runs, it runs in a second small pool and the full result
+replaces it.
+"""
+
+JOB_DIR = "./jobs"
+# pool processes per web worker, by default the cores are split between the gunicorn workers
+MAX_WORKERS = int(os.environ.get("WRIST_JOB_WORKERS",
+                                 max(1, (os.cpu_count() or 1) // int(os.environ.get("WEB_CONCURRENCY", 1)))))
+# processes per web worker for the quick estimates, kept apart so they never wait behind full jobs
+QUICK_WORKERS = int(os.environ.get("WRIST_QUICK_WORKERS", 1))
+
+_executor = None
+_quick_executor = None
+_futures = set()  # submitted jobs not finished yet
+_pool_lock = threading.Lock()  # one thread replaces a broken pool
+
+
+def _init_worker():
+    # pool processes open their own database connections and share the loaded models between jobs
+    engine.dispose()
+    model_registry.load_models()
+
+
+def _init_quick_worker():
+    # the quick estimate uses no model file
+    engine.dispose()
+
+
+def _start_pool(quick=False):
+    if quick:
+        return ProcessPoolExecutor(max_workers=QUICK_WORKERS, initializer=_init_quick_worker)
+    return ProcessPoolExecutor(max_workers=MAX_WORKERS, initializer=_init_worker)
+
+
+def start_workers():
+    """
+    Start the process pool and resubmit the unfinished jobs
+    """
+    global _executor, _quick_executor
+    _executor = _start_pool()
+    _quick_executor = _start_pool(quick=True)
+    for job_id in recover_jobs():
+        _submit(job_id)
+
+
+def stop_workers():
+    """
+    Stop the process pool once the running jobs finish, queued jobs stay in the job table for the next start
+    """
+    for future in list(_futures):
+        future.cancel()
+    for executor in (_executor, _quick_executor):
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+def _submit(job_id, quick=False):
+    executor = _quick_executor if quick else _executor
+    try:
+        future = executor.submit(run_quick if quick else run_job, job_id)
+    except BrokenProcessPool:
+        # a pool process died, e.g. killed when out of memory, and the pool takes no more work
+        _replace_pool(executor, quick)
+        if quick:
+            _submit(job_id, quick)
+        else:
+            # the job of the dead process is queued again, with the jobs still waiting in the broken pool
+            for queued_id in recover_jobs():
+                _submit(queued_id)
+        return
+    _futures.add(future)
+    future.add_done_callback(_futures.discard)
+
+
+def _replace_pool(broken, quick=False):
+    global _executor, _quick_executor
+    with _pool_lock:
+        if broken is not (_quick_executor if quick else _executor):
+            return  # already replaced by another thread
+        print("job pool broken, starting a new one")
+        # the processes of the broken pool are terminated, waiting for them lets recover_jobs see them gone
+        broken.shutdown(wait=True)
+        if quick:
+            _quick_executor = _start_pool(quick=True)
+        else:
+            _executor = _start_pool()
+
+
+def submit_quick(job_id):
+    """
+    Queue the quick accelerometer only estimate of a wrist job on the quick pool, see run_quick
+    """
+    _submit(job_id, quick=True)
+
+
+def pool_model_info(timeout=10):
+    """
+    Models loaded in a process of the job pool, see model_registry.model_info
+    Runs as a task of the pool, so it waits for a free process behind the queued jobs.
+    :param timeout: float
+        seconds to wait for a pool process
+    :return: dict
+        name -> path, modified time, load seconds and size in bytes, None if no process was free in time
+    """
+    try:
+        future = _executor.submit(model_registry.model_info)
+    except BrokenProcessPool:  # replaced by the next job submit
+        return None
+    try:
+        return future.result(timeout=timeout)
+    except (TimeoutError, BrokenProcessPool):
+        future.cancel()
+        return None
+
+
+def submit_wrist_job(uploads, options=None, kind='wrist'):
+    """
+    Save the uploaded files and queue a wrist job
+    :param uploads: list
+        UploadFile objects, gyro and accelerometer csv
+    :param options: dict
+        processing options, e.g. {'stream': True, 'accel_only': False, 'subject': 'S01', 'session': 'visit1'}
+    :param kind: str
+        'wrist' for a whole recording, 'append' for the rows recorded since the previous upload of a session
+        (run_append)
+    :return: int
+        job id
+    """
+    db = SessionLocal()
+    key = None
+    try:
+        job = Job(kind=kind, status='saving', progress=0.0, options=json.dumps(options or {}),
+                  owner=process_identity(os.getpid()), created=datetime.now(), updated=datetime.now())
+        db.add(job)
+        db.commit()
+        job_id = job.id
+
+        job_dir = os.path.join(JOB_DIR, str(job_id))
+        try:
+            os.makedirs(job_dir, exist_ok=True)
+            paths = []
+            digests = []
+            for i, upload in enumerate(uploads):
+                path = os.path.join(job_dir, '{}_{}'.format(i, os.path.basename(upload.filename or 'upload.csv')))
+                with open(path, 'wb') as saved:
+                    digests.append(result_cache.copy_and_hash(upload.file, saved))
+                paths.append(path)
+
+            if kind == 'wrist':
+                key = result_cache.cache_key(digests, model_registry.model_version(), process.DEMOGRAPHICS,
+                                             'accel' if (options or {}).get('accel_only') else 'wrist')
+        except Exception as e:  # e.g. disk full or a missing model file, the job is never left saving
+            traceback.print_exc()
+            db.rollback()
+            shutil.rmtree(job_dir, ignore_errors=True)
+            fail_job(job_id, 'upload could not be saved: {}'.format(e))
+            return job_id
+        job.files = json.dumps(paths)
+        if kind == 'wrist':
+            job.recording = feature_store.recording_key(digests)
+            job.options = json.dumps(dict(options or {}, cache_key=key, recording=job.recording))
+        job.status = 'queued'
+        job.updated = datetime.now()
+        db.commit()
+    finally:
+        db.close()
+
+    cached = None if key is None else result_cache.get(key)
+    if cached is not None and claim_job(job_id):
+        # same files and models as an earlier upload, nothing to compute
+        try:
+            store_result(job_id, cached, options)
+        except Exception as e:
+            traceback.print_exc()
+            fail_job(job_id, str(e))
+        return job_id
+
+    _submit(job_id)
+    return job_id
+
+
+def run_job(job_id):
+    """
+    Run a queued wrist job in a pool process and store its minute mets
+    :param job_id: int
+        job to run, skipped when another process already claimed it
+    """
+    if not claim_job(job_id):
+        return
+    try:
+        job = read_job(job_id)
+        paths = json.loads(job['files'])
+        options = json.loads(job['options'] or '{}')
+        if job['kind'] == 'reinfer':
+            run_reinfer(job_id, options)
+            return
+        if job['kind'] == 'append':
+            run_append(job_id, options)
+            return
+
+        recording = options.get('recording')
+        if options.get('accel_only'):
+            # fast mode, accelerometer file only and no stored features
+            output_wrist_df = process.process_wrist_files(paths, accel_only=True)
+        else:
+            # features of these files may be stored, e.g. only the models changed since they were uploaded
+            output_wrist_df = None if recording is None else process.infer_recording(recording)
+        if output_wrist_df is None:  # not stored, or evicted from the feature store meanwhile
+            # serial features, the job pool already runs a job per core
+            output_wrist_df = process.process_wrist_files(paths, stream=options.get('stream', False),
+                                                          progress=lambda done: update_job(job_id, progress=0.8 * done),
+                                                          workers=1, recording=recording)
+        if not isinstance(output_wrist_df, pd.DataFrame):
+            fail_job(job_id, 'expected one accelerometer and one gyroscope csv')
+            return
+
+        update_job(job_id, progress=0.9)
+        if options.get('cache_key'):
+            result_cache.put(options['cache_key'], output_wrist_df)
+        store_result(job_id, output_wrist_df, options)
+    except Exception as e:
+        traceback.print_exc()
+        fail_job(job_id, str(e))
+
+
+def run_append(job_id, options):
+    """
+    Apply the pending uploads of a session, up to this job and in upload order, and append the minutes they complete
+    The minutes are computed outside of any transaction. The new state is stored only if no other job changed it
+    since it was read, the rows are inserted and the applied jobs marked done in the same transaction,
+    otherwise everything is read again. A job applied meanwhile by the job of a later upload has nothing left to do.
+    :param job_id: int
+        claimed append job
+    :param options: dict
+        job options, with the subject and session
+    """
+    subject = options.get('subject', DEFAULT_SUBJECT)
+    session = options.get('session', DEFAULT_SESSION)
+    while True:
+        state, version = incremental.load_state(subject, session)
+        pending = _pending_appends(job_id, subject, session)
+        if job_id not in [row['id'] for row in pending]:
+            return
+
+        applied = []
+        invalid = []
+        for row in pending:
+            (applied if incremental.push_files(state, json.loads(row['files'])) else invalid).append(row['id'])
+        new_minutes = state.estimate(state.complete_minutes(), workers=1)  # serial like run_job
+
+        with engine.begin() as connection:
+            swapped = incremental.save_state(connection, state, subject, session, version)
+            if swapped:
+                if len(new_minutes):
+                    insert_mets(connection, Wrist.__table__, new_minutes, subject, session,
+                                provisional=False, job_id=job_id)
+                if applied:
+                    connection.execute(Job.__table__.update().where(Job.id.in_(applied)).values(
+                        status='done', progress=1.0, message='{} minutes appended'.format(len(new_minutes)),
+                        updated=datetime.now()))
+                if invalid:
+                    connection.execute(Job.__table__.update().where(Job.id.in_(invalid)).values(
+                        status='failed', message='expected accelerometer or gyroscope csv files',
+                        updated=datetime.now()))
+        if swapped:
+            for row in pending:
+                shutil.rmtree(os.path.join(JOB_DIR, str(row['id'])), ignore_errors=True)
+            return
+
+
+def _pending_appends(job_id, subject, session):
+    # queued or running append jobs of the session up to job_id, in upload order
+    with engine.connect() as connection:
+        rows = connection.execute(Job.__table__.select().where(Job.kind == 'append').where(Job.id <= job_id)
+                                  .where(Job.status.in_(['queued', 'running'])).order_by(Job.id)).fetchall()
+    pending = []
+    for row in rows:
+        options = json.loads(row['options'] or '{}')
+        if options.get('subject', DEFAULT_SUBJECT) == subject and options.get('session', DEFAULT_SESSION) == session:
+            pending.append(row)
+    return pending
+
+
+def run_quick(job_id):
+    """
+    Store the quick accelerometer only estimate of a wrist job as provisional rows
+    Runs in the quick pool next to the job, skips gyroscope resampling and the classification model.
+    Nothing is stored once the job finished, the full result then deletes the provisional rows.
+    :param job_id: int
+        queued or running wrist job
+    """
+    job = read_job(job_id)
+    if job is None or job['status'] not in ('queued', 'running'):
+        return
+    options = json.loads(job['options'] or '{}')
+    try:
+        quick_df = process.process_wrist_files(json.loads(job['files']), accel_only=True)
+    except Exception as e:  # e.g. the job finished and removed its files meanwhile
+        print("quick estimate of job {} skipped: {}".format(job_id, e))
+        return
+    if not isinstance(quick_df, pd.DataFrame):
+        return
+
+    with engine.begin() as connection:
+        # checked in the same transaction as the insert, the full result is never overwritten
+        result = connection.execute(Job.__table__.update().where(Job.id == job_id)
+                                    .where(Job.status.in_(['queued', 'running']))
+                                    .values(message='provisional results available', updated=datetime.now()))
+        if result.rowcount == 1:
+            insert_mets(connection, Wrist.__table__, quick_df,
+                        options.get('subject', DEFAULT_SUBJECT), options.get('session', DEFAULT_SESSION),
+                        provisional=True, job_id=job_id)
+
+
+def submit_reinfer_job(subject=None, session=None):
+    """
+    Queue a job estimating the stored recordings again with the current models
+    :param subject: str
+        only the recordings of this subject, every subject by default
+    :param session: str
+        only the recordings of this session, every session by default
+    :return: int
+        job id
+    """
+    with engine.begin() as connection:
+        result = connection.execute(Job.__table__.insert().values(
+            kind='reinfer', status='queued', progress=0.0, files='[]',
+            options=json.dumps({'subject': subject, 'session': session}), created=datetime.now(), updated=datetime.now()))
+        job_id = result.inserted_primary_key[0]
+    _submit(job_id)
+    return job_id
+
+
+def stored_recordings(subject=None, session=None):
+    """
+    Finished wrist jobs whose features are stored, the recordings a reinfer job estimates again
+    Accelerometer only jobs are left out.
+    :param subject: str
+        only the jobs of this subject, every subject by default
+    :param session: str
+        only the jobs of this session, every session by default
+    :return: list
+        {'recording', 'job_id', 'subject', 'session'} per job, oldest first
+    """
+    stored = set(feature_store.recordings())
+    with engine.connect() as connection:
+        rows = connection.execute(Job.__table__.select().where(Job.kind == 'wrist').where(Job.status == 'done')
+                                  .where(Job.recording.isnot(None)).order_by(Job.id)).fetchall()
+    jobs = []
+    for row in rows:
+        options = json.loads(row['options'] or '{}')
+        if row['recording'] not in stored or options.get('accel_only'):  # accelerometer only rows stay as they are
+            continue
+        if subject is not None and options.get('subject', DEFAULT_SUBJECT) != subject:
+            continue
+        if session is not None and options.get('session', DEFAULT_SESSION) != session:
+            continue
+        jobs.append({'recording': row['recording'], 'job_id': row['id'],
+                     'subject': options.get('subject', DEFAULT_SUBJECT),
+                     'session': options.get('session', DEFAULT_SESSION)})
+    return jobs
+
+
+def run_reinfer(job_id, options):
+    """
+    Estimate the stored recordings again and replace the rows of their jobs, all in one transaction
+    Only the models run, recordings whose rows were cleared since are left out.
+    :param job_id: int
+        claimed reinfer job
+    :param options: dict
+        job options, with the optional subject and session
+    """
+    recordings = stored_recordings(options.get('subject'), options.get('session'))
+    results = []
+    for i, recording in enumerate(recordings):
+        output_wrist_df = process.infer_recording(recording['recording'])
+        if output_wrist_df is not None and len(output_wrist_df):
+            results.append((recording, output_wrist_df))
+        update_job(job_id, progress=0.9 * (i + 1) / len(recordings))
+
+    replaced = 0
+    with engine.begin() as connection:
+        for recording, output_wrist_df in results:
+            deleted = connection.execute(Wrist.__table__.delete().where(Wrist.job_id == recording['job_id']))
+            if deleted.rowcount == 0:
+                continue
+            insert_mets(connection, Wrist.__table__, output_wrist_df, recording['subject'], recording['session'],
+                        provisional=False, job_id=recording['job_id'])
+            replaced += 1
+        connection.execute(Job.__table__.update().where(Job.id == job_id).values(
+            status='done', progress=1.0, message='{} recordings estimated again'.format(replaced),
+            updated=datetime.now()))
+
+
+def fail_job(job_id, message):
+    """
+    Mark a job failed and remove its provisional rows
+    """
+    with engine.begin() as connection:
+        connection.execute(Wrist.__table__.delete().where(Wrist.job_id == job_id).where(Wrist.provisional == True))
+        bump_data_version(connection)
+        connection.execute(Job.__table__.update().where(Job.id == job_id).values(
+            status='failed', message=message, updated=datetime.now()))
+
+
+def store_result(job_id, output_wrist_df, options=None):
+    """
+    Write the minute mets of a claimed job and mark it done
+    :param job_id: int
+        job the mets belong to
+    :param output_wrist_df: dataframe
+        timestamp and mets columns
+    :param options: dict
+        job options, with the subject and session of the rows
+    """
+    options = options or {}
+    # results and job status are committed together, a restart never stores a job twice
+    with engine.begin() as connection:
+        # the full result replaces the quick estimate
+        connection.execute(Wrist.__table__.delete().where(Wrist.job_id == job_id).where(Wrist.provisional == True))
+        insert_mets(connection, Wrist.__table__, output_wrist_df,
+                    options.get('subject', DEFAULT_SUBJECT), options.get('session', DEFAULT_SESSION),
+                    provisional=False, job_id=job_id)
+        connection.execute(Job.__table__.update().where(Job.id == job_id).values(
+            status='done', progress=1.0, message=None, updated=datetime.now()))
+    shutil.rmtree(os.path.join(JOB_DIR, str(job_id)), ignore_errors=True)
+
+
+def claim_job(job_id):
+    """
+    Mark a queued job as running in this process
+    :return: bool
+        True if this process got the job
+    """
+    with engine.begin() as connection:
+        result = connection.execute(Job.__table__.update().where(Job.id == job_id).where(Job.status == 'queued').values(
+            status='running', progress=0.05, pid=os.getpid(), owner=process_identity(os.getpid()),
+            updated=datetime.now()))
+    return result.rowcount == 1
+
+
+def read_job(job_id):
+    """
+    Job row as a dict, None if there is no such job
+    """
+    with engine.connect() as connection:
+        row = connection.execute(Job.__table__.select().where(Job.id == job_id)).fetchone()
+    return None if row is None else dict(row)
+
+
+def update_job(job_id, **values):
+    """
+    Update the status, progress or message of a job
+    """
+    values['updated'] = datetime.now()
+    with engine.begin() as connection:
+        connection.execute(Job.__table__.update().where(Job.id == job_id).values(**values))
+
+
+def recover_jobs():
+    """
+    Queue again the running jobs whose process is gone, uploads left saving by a process that is gone fail
+    :return: list
+        ids of the queued jobs
+    """
+    with engine.begin() as connection:
+        rows = connection.execute(Job.__table__.select().where(Job.status.in_(['saving', 'running']))).fetchall()
+        for row in rows:
+            if _owner_alive(row['owner']):
+                continue
+            if row['status'] == 'running':
+                connection.execute(Job.__table__.update().where(Job.id == row['id']).where(Job.status == 'running')
+                                   .values(status='queued', updated=datetime.now()))
+            else:  # the files were never completely saved, the upload has to be sent again
+                connection.execute(Job.__table__.update().where(Job.id == row['id']).where(Job.status == 'saving')
+                                   .values(status='failed', message='upload interrupted', updated=datetime.now()))
+        rows = connection.execute(Job.__table__.select().where(Job.status == 'queued')).fetchall()
+    return [row['id'] for row in rows]
+
+
+def process_identity(pid):
+    """
+    Identity of a live process that a restart does not reuse: boot id, pid and start time of the process
+    :param pid: int
+        process id
+    :return: str
+        None if the process is gone or /proc is not available (outside docker only a single dev server runs)
+    """
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as boot:
+            boot_id = boot.read().strip()
+        with open('/proc/{}/stat'.format(int(pid))) as stat:
+            # starttime is field 22, the fields after the parenthesized command name start at field 3
+            start_time = stat.read().rsplit(')', 1)[1].split()[19]
+    except (OSError, ValueError, IndexError):
+        return None
+    return '{}:{}:{}'.format(boot_id, int(pid), start_time)
+
+
+def _owner_alive(owner):
+    # owner is the process_identity stored with the job, None when /proc was not available
+    if owner is None:
+        return False
+    return process_identity(owner.split(':')[1]) == owner
@@ -1,18 +1,21 @@
 import os
+from datetime import datetime
 from typing import List
-from fastapi import FastAPI, File, UploadFile, Request, Depends, BackgroundTasks
+from fastapi import FastAPI, File, UploadFile, Request, Depends, BackgroundTasks, HTTPException, Response
 from pydantic import BaseModel  # define schema for API
 from fastapi.templating import Jinja2Templates
 import pandas as pd
-import process
-from support_functions import resample, get_intensity, extract_features, get_met_vm3, actigraph_add_datetime
+import jobs
+import incremental
+from support_functions import get_met_vm3_all, actigraph_add_datetime
 from sqlalchemy.orm import Session
 from database import SessionLocal, engine
 import models
-from models import Acti, Wrist
-import plotly as py
-from plotly.offline import plot
-import plotly.graph_objects as go
+from models import Acti, Wrist, Job, DEFAULT_SUBJECT, DEFAULT_SESSION
+from persistence import save_mets, session_filter, bump_data_version
+from migrations import migrate
+import queries
+import plots
 from fastapi.middleware.cors import CORSMiddleware
 
 
@@ -42,17 +45,43 @@ app.add_middleware(
 )
 
 models.Base.metadata.create_all(bind=engine) # create sqlalchemy base model objects
+migrate(engine)  # columns and indexes added since the database was created
 
 templates = Jinja2Templates(directory="templates") # load frontend template
 
 
+@app.on_event("startup")
+def start_job_workers():
+    """
+    Start the wrist job pool and resume unfinished jobs
+    """
+    jobs.start_workers()
+
+
+@app.on_event("shutdown")
+def stop_job_workers():
+    jobs.stop_workers()
+
+
+@app.get("/models/")
+def models_info():
+    """
+    Load time and memory footprint of the models loaded by the job pool processes, which run the uploads
+    """
+    info = jobs.pool_model_info()
+    if info is None:
+        raise HTTPException(status_code=503, detail="job pool busy, try again later")
+    return info
+
+
 @app.get("/")
-def home(request: Request, db : Session = Depends(get_db)):
+def home(request: Request, subject: str = None, session: str = None, db : Session = Depends(get_db)):
     """
     Displays the dashboard for wrist ml application
+    subject and session show a single subject and/or session, all data by default
     """
-    acti = db.query(Acti).all()
-    wrist = db.query(Wrist).all()
+    acti = session_filter(db.query(Acti), Acti, subject, session).all()
+    wrist = session_filter(db.query(Wrist), Wrist, subject, session).all()
 
     return templates.TemplateResponse("home.html", {
         "request": request,
@@ -61,204 +90,161 @@ def home(request: Request, db : Session = Depends(get_db)):
     })
 
 
-def process_acti(file):
+def process_acti(file, subject=DEFAULT_SUBJECT, session=DEFAULT_SESSION):
     """
     process actical files
     """
     df_acti_og = pd.read_csv(file.file, index_col=None)
 
-    actigraph_add_datetime(df_acti_og)
-    minute_acti = []
-    estimation_acti = []
-    for i in range(len(df_acti_og)):
-        minute_acti.append(df_acti_og['Datetime'][i])
-        estimation_acti.append(get_met_vm3(df_acti_og, df_acti_og['Datetime'][i]))
+    failed = actigraph_add_datetime(df_acti_og)
+    df_acti_og = df_acti_og.drop(failed)  # skip unparsable rows instead of failing the upload
     # save output
-    output_acti_df = pd.DataFrame(list(zip(minute_acti, estimation_acti)),
-                               columns=['timestamp', 'mets'])
-    output_acti_df.to_sql('acti', engine, if_exists='append', index=False)
+    output_acti_df = pd.DataFrame({'timestamp': df_acti_og['Datetime'].values,
+                                   'mets': get_met_vm3_all(df_acti_og)})
+    save_mets(Acti.__table__, output_acti_df, subject, session)
 
 
 @app.post("/actifile/")
-async def create_upload_file( background_tasks: BackgroundTasks, file: UploadFile = File(...), db : Session = Depends(get_db)):
+async def create_upload_file( background_tasks: BackgroundTasks, file: UploadFile = File(...),
+                              subject: str = DEFAULT_SUBJECT, session: str = DEFAULT_SESSION, db : Session = Depends(get_db)):
     """
     upload a single actical file
     """
-    background_tasks.add_task(process_acti, file)
+    background_tasks.add_task(process_acti, file, subject, session)
     return {"status": "success"}
 
 
-def process_wrist(files):
+@app.post("/wristfiles/")
+def create_upload_files(files: List[UploadFile] = File(...), stream: bool = False,
+                        accel_only: bool = False, quick: bool = True, subject: str = DEFAULT_SUBJECT,
+                        session: str = DEFAULT_SESSION, db: Session = Depends(get_db)):
     """
-    process list of wrist files
+    upload multiple wrist files, accl and gyro
+    the files are processed by a job, poll /jobs/{job_id} for its status
+    stream=true processes the files in chunks to bound memory on long recordings
+    accel_only=true is the fast mode, mets are estimated from the accelerometer alone
+    quick=true stores a provisional accelerometer only estimate within seconds, replaced by the full result
     """
-    data_list = [] # hold dataframe from gyro and accl wrist csv file
-    for wrist_file in files:
-        # find and load gyro and accel files, then resample to 20hz
-        df_wrist_og = pd.read_csv(wrist_file.file, index_col=None, header=0)
-        df_wrist = resample(df_wrist_og, 'Time', 20, 100)
-        df_wrist['Datetime'] = pd.to_datetime(df_wrist['Time'], unit='ms', utc=True).dt.tz_convert(
-            'America/Chicago').dt.tz_localize(None)
-        data_list.append(df_wrist)
+    job_id = jobs.submit_wrist_job(files, {'stream': stream, 'accel_only': accel_only,
+                                           'subject': subject, 'session': session})
+    if quick and not accel_only:
+        jobs.submit_quick(job_id)
+    return {"status": "success", "job_id": job_id}
 
-    output_wrist_df = process.process_wrist_data(data_list)
-    output_wrist_df.to_sql('wrist', engine, if_exists='append', index=False)
-        
 
-@app.post("/wristfiles/")
-async def create_upload_files(background_tasks: BackgroundTasks, files: List[UploadFile] = File(...), db: Session = Depends(get_db)):
+@app.post("/wristfile/")
+def create_upload_wrist(file: UploadFile = File(...), accel_only: bool = False, subject: str = DEFAULT_SUBJECT,
+                        session: str = DEFAULT_SESSION, db: Session = Depends(get_db)):
     """
-    upload multiple wrist files, accl and gyro
+    upload SINGLE wrist file either accl or gyro
+    Needed to handle each file seperate as 30MB max request size for kestral in Azure
+    accel_only=true estimates the mets of a single accelerometer file (fast mode)
     """
-    background_tasks.add_task(process_wrist, files)
-    return {"status": "success"}
+    job_id = jobs.submit_wrist_job([file], {'accel_only': accel_only, 'subject': subject, 'session': session})
+    return {"status": "success", "job_id": job_id}
 
 
-def process_single_wrist(wrist_file):
+@app.post("/wristfiles/append/")
+def append_wrist_files(files: List[UploadFile] = File(...), subject: str = DEFAULT_SUBJECT,
+                       session: str = DEFAULT_SESSION):
     """
-    process list of wrist files
-    Needed to handle each file seperate as 30MB max request size for kestral in Azure
+    upload the wrist rows recorded since the previous upload of a subject and session, accl and/or gyro
+    only the minutes completed by these rows are processed and appended, the partial last minute
+    waits for the next upload. The uploads of a session are applied by a job in the order they arrive,
+    poll /jobs/{job_id} for the status
+    """
+    job_id = jobs.submit_wrist_job(files, {'subject': subject, 'session': session}, kind='append')
+    return {"status": "success", "job_id": job_id}
+
+
+@app.get("/recordings/")
+def list_recordings(subject: str = None, session: str = None):
+    """
+    finished wrist jobs whose minute features are stored, they can be estimated again without the upload
     """
-    # find and load gyro and accel files, then resample to 20hz
-    df_wrist_og = pd.read_csv(wrist_file.file, index_col=None, header=0)
-    df_wrist = resample(df_wrist_og, 'Time', 20, 100)
-    df_wrist['Datetime'] = pd.to_datetime(df_wrist['Time'], unit='ms', utc=True).dt.tz_convert(
-        'America/Chicago').dt.tz_localize(None)
+    return jobs.stored_recordings(subject, session)
+
 
-    output_wrist_df = process.process_wrist_data(df_wrist)
-    output_wrist_df.to_sql('wrist', engine, if_exists='append', index=False)
+@app.post("/recordings/reinfer/")
+def reinfer_recordings(subject: str = None, session: str = None):
+    """
+    estimate the stored recordings again with the current models, e.g. after a model rollout
+    the rows of each job are replaced, poll /jobs/{job_id} for the status
+    """
+    return {"status": "success", "job_id": jobs.submit_reinfer_job(subject, session)}
 
 
-@app.post("/wristfile/")
-async def create_upload_wrist(background_tasks: BackgroundTasks, file: UploadFile = File(...), db: Session = Depends(get_db)):
+@app.get("/jobs/{job_id}")
+def job_status(job_id: int, db: Session = Depends(get_db)):
     """
-    upload SINGLE wrist file either accl or gyro
+    status of a wrist processing job
     """
-    background_tasks.add_task(process_single_wrist, file)
-    return {"status": "success"}
+    job = db.query(Job).get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {"id": job.id,
+            "kind": job.kind,
+            "status": job.status,
+            "progress": job.progress,
+            "message": job.message,
+            "created": job.created,
+            "updated": job.updated}
 
 
-@app.post("/plot/")
-def results(db : Session = Depends(get_db)):
-    """
-    plot the data on graph
-    """
-    acti = db.query(Acti).all()
-    wrist = db.query(Wrist).all()
-
-    acti_time = [i.timestamp for i in acti]
-    acti_mets = [i.mets for i in acti]
-
-    wrist_time = [i.timestamp for i in wrist]
-    wrist_mets = [i.mets for i in wrist]
-
-    # Figure 1: plot Proposed vs ActiGraph METs
-    fig1 = go.Figure()
-    fig1.add_trace(go.Scatter(
-        x = acti_mets,
-        y = wrist_mets,
-        mode='markers',
-        name='METs'
-    ))
-    fig1.update_layout(
-        title='MET Comparison: Proposed vs ActiGraph',
-        xaxis_title='MET (ActiGraph)',
-        yaxis_title='MET (Proposed)',
-        template='plotly_white'
-    )
-    plot_div1 = py.offline.plot(fig1, output_type='div')   
-
-    # Figure 2: plot METs trend over timestamp
-    fig2 = go.Figure()
-    fig2.add_trace(go.Scatter(
-        x=acti_time,
-        y=acti_mets,
-        mode='lines+markers',
-        name='ActiGraph MET'
-    ))
-    fig2.add_trace(go.Scatter(
-        x=wrist_time,
-        y=wrist_mets,
-        mode='lines+markers',
-        name='Proposed/Wrist MET'
-    ))
-    fig2.update_layout(
-        title='METs Trend: ActiGraph vs. Proposed',
-        xaxis_title='Time',
-        yaxis_title='METs',
-        template='plotly_white',
-        legend=dict(x=0, y=1.1, orientation='h')
-    )
-    plot_div2 = py.offline.plot(fig2, output_type='div')   
-
-    # Figure 3: plot cumulative kCal over timestamp
-    # weight (for kCal)
-    weight_kg = 94.5
-    df_acti = pd.DataFrame({'timestamp': acti_time, 'mets': acti_mets})
-    df_wrist = pd.DataFrame({'timestamp': wrist_time, 'mets': wrist_mets})
-    df_acti['timestamp'] = pd.to_datetime(df_acti['timestamp'])
-    df_wrist['timestamp'] = pd.to_datetime(df_wrist['timestamp'])
-    df_acti['kcal'] = df_acti['mets'].astype(float) * 3.5 * float(weight_kg) / 200
-    df_wrist['kcal'] = df_wrist['mets'].astype(float) * 3.5 * float(weight_kg) / 200
-    df_acti['cumulative_kcal'] = df_acti['kcal'].cumsum()
-    df_wrist['cumulative_kcal'] = df_wrist['kcal'].cumsum()
-    final_acti_kcal = df_acti['cumulative_kcal'].iloc[-1]
-    final_acti_time = df_acti['timestamp'].iloc[-1]
-    final_wrist_kcal = df_wrist['cumulative_kcal'].iloc[-1]
-    final_wrist_time = df_wrist['timestamp'].iloc[-1]
-
-    fig3 = go.Figure()
-    fig3.add_trace(go.Scatter(
-        x=df_acti['timestamp'],
-        y=df_acti['cumulative_kcal'],
-        mode='lines+markers',
-        name='ActiGraph Cumulative kCal'
-    ))
-    fig3.add_trace(go.Scatter(
-        x=df_wrist['timestamp'],
-        y=df_wrist['cumulative_kcal'],
-        mode='lines+markers',
-        name='Proposed Cumulative kCal'
-    ))
-    fig3.add_annotation(
-        x=final_acti_time,
-        y=final_acti_kcal,
-        text=f"{final_acti_kcal:.1f} kcal",
-        showarrow=True,
-        arrowhead=2,
-        ax=0,
-        ay=-20,
-        font=dict(color="blue")
-    )
-    fig3.add_annotation(
-        x=final_wrist_time,
-        y=final_wrist_kcal,
-        text=f"{final_wrist_kcal:.1f} kcal",
-        showarrow=True,
-        arrowhead=2,
-        ax=0,
-        ay=-20,
-        font=dict(color="green")
-    )
-    fig3.update_layout(
-        title='Cumulative Energy Expenditure Over Time',
-        xaxis_title='Time',
-        yaxis_title='Cumulative kCal',
-        template='plotly_white',
-        legend=dict(x=0, y=1.1, orientation='h')
-    )
-    plot_div3 = py.offline.plot(fig3, output_type='div')
-    return {'plot1': plot_div1,
-            'plot2': plot_div2,
-            'plot3': plot_div3}
+@app.get("/jobs/{job_id}/progress")
+def job_progress(job_id: int, db: Session = Depends(get_db)):
+    """
+    progress of a wrist processing job, for polling
+    """
+    job = db.query(Job).get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {"status": job.status, "progress": job.progress}
 
 
+@app.get("/mets/{kind}")
+def read_mets(kind: str, subject: str = DEFAULT_SUBJECT, session: str = DEFAULT_SESSION, start: datetime = None,
+              end: datetime = None, cursor: str = None, limit: int = queries.DEFAULT_LIMIT, resolution: int = None):
+    """
+    minute mets of a subject's session as json, kind is acti or wrist
+    pass next_cursor back as cursor for the next page, resolution (seconds) averages the minutes of each bucket
+    """
+    if kind not in queries.TABLES:
+        raise HTTPException(status_code=404, detail="Unknown kind")
+    if resolution is not None and resolution < 1:
+        raise HTTPException(status_code=400, detail="resolution must be at least 1 second")
+    try:
+        return queries.read_mets(kind, subject, session, start, end, cursor, limit, resolution)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post("/plot/")
+def results(subject: str = None, session: str = None, max_points: int = None):
+    """
+    data of the plots as plotly.js figures, rendered by the browser
+    subject and session plot a single subject and/or session, all data by default
+    max_points downsamples long recordings to at most that many points per trace
+    the json is cached until new data is uploaded or cleared
+    """
+    if max_points is not None and max_points < 3:
+        raise HTTPException(status_code=400, detail="max_points must be at least 3")
+    return Response(content=plots.cached_figures(subject, session, max_points), media_type="application/json")
+
 
 @app.post("/clear/")
-def clear_db(db : Session = Depends(get_db)):
+def clear_db(subject: str = None, session: str = None, db : Session = Depends(get_db)):
     """
     clear data from db
-    """
-    db.query(Acti).delete()
-    db.query(Wrist).delete()
+    subject and session clear a single subject and/or session, all data by default
+    """
+    for model in (Acti, Wrist):
+        query = db.query(model)
+        if subject is not None:
+            query = query.filter(model.subject == subject)
+        if session is not None:
+            query = query.filter(model.session == session)
+        query.delete(synchronize_session=False)
+    incremental.reset_sessions(db, subject, session)
+    bump_data_version(db)
     db.commit()
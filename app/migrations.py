@@ -0,0 +1,70 @@
+from models import DEFAULT_SUBJECT, DEFAULT_SESSION
+
+"""
+Schema migrations of existing wristml.db files.
+create_all only creates missing tables, so the columns and indexes added to existing
+tables are applied here. The schema version is kept in PRAGMA user_version.
+"""
+
+
+def _add_sessions(connection):
+    # subject/session keys and (subject, session, timestamp) indexes on acti and wrist
+    for table in ('acti', 'wrist'):
+        columns = [row[1] for row in connection.execute("PRAGMA table_info({})".format(table)).fetchall()]
+        if 'subject' not in columns:
+            connection.execute("ALTER TABLE {} ADD COLUMN subject VARCHAR NOT NULL DEFAULT '{}'".format(
+                table, DEFAULT_SUBJECT))
+        if 'session' not in columns:
+            connection.execute("ALTER TABLE {} ADD COLUMN session VARCHAR NOT NULL DEFAULT '{}'".format(
+                table, DEFAULT_SESSION))
+        # timestamps are only unique within a subject's session now
+        connection.execute("DROP INDEX IF EXISTS ix_{}_timestamp".format(table))
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_{0}_subject_session_timestamp "
+                           "ON {0} (subject, session, timestamp)".format(table))
+
+
+def _add_provisional(connection):
+    # provisional quick estimates in wrist, tagged with the job that replaces them
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(wrist)").fetchall()]
+    if 'provisional' not in columns:
+        connection.execute("ALTER TABLE wrist ADD COLUMN provisional BOOLEAN NOT NULL DEFAULT 0")
+    if 'job_id' not in columns:
+        connection.execute("ALTER TABLE wrist ADD COLUMN job_id INTEGER")
+
+
+# migration of each schema version, in order
+MIGRATIONS = [
+    _add_sessions,  # 1
+    _add_provisional,  # 2
+]
+
+
+def migrate(engine):
+    """
+    Bring the database to the latest schema version, call after create_all
+    Every web worker calls it at startup, the first one migrates while the others wait.
+    :param engine: engine
+        sqlalchemy engine of the database
+    :return: int
+        schema version of the database
+    """
+    raw = engine.raw_connection()
+    connection = raw.connection  # sqlite3 connection, transactions are handled explicitly below
+    isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    try:
+        connection.execute("BEGIN IMMEDIATE")  # holds the write lock from reading the version to the commit
+        try:
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+                print("Migrating database to schema version {}".format(number))
+                migration(connection)
+                connection.execute("PRAGMA user_version = {}".format(number))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+    finally:
+        connection.isolation_level = isolation_level
+        raw.close()
+    return max(version, len(MIGRATIONS))
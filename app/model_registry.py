@@ -0,0 +1,104 @@
+import hashlib
+import os
+import pickle
+import threading
+import time
+import joblib
+from xgboost import XGBClassifier
+
+"""
+Process-wide registry of the pre-trained WRIST models.
+Models are loaded once per process (by each job pool process when it starts) and shared by its jobs,
+a model is reloaded when its file changes on disk.
+"""
+
+CLASSIFICATION_MODEL_PATH = "./classification_model.json"
+REGRESSION_MODEL_PATH = "./regression_model.joblib"
+
+_LOCK = threading.Lock()
+_MODELS = {}  # name -> {'model', 'path', 'mtime', 'load_seconds', 'size_bytes'}
+
+
+def _load_classification(path):
+    model = XGBClassifier()
+    model.load_model(path)
+    return model
+
+
+_LOADERS = {
+    'classification': (CLASSIFICATION_MODEL_PATH, _load_classification),
+    'regression': (REGRESSION_MODEL_PATH, joblib.load),
+}
+
+
+def _load(name):
+    """
+    Load a model from disk and record its load time and memory footprint
+    :param name: str
+        'classification' or 'regression'
+    """
+    path, loader = _LOADERS[name]
+    mtime = os.path.getmtime(path)
+    start = time.perf_counter()
+    model = loader(path)
+    load_seconds = time.perf_counter() - start
+    _MODELS[name] = {
+        'model': model,
+        'path': path,
+        'mtime': mtime,
+        'load_seconds': load_seconds,
+        'size_bytes': len(pickle.dumps(model)),  # serialized size, approximates the in-memory footprint
+    }
+    print("Loaded {} model from {} in {:.2f}s".format(name, path, load_seconds))
+
+
+def load_models():
+    """
+    Load every model, called once when a job pool process starts.
+    A model that fails to load is reported and retried on first use.
+    """
+    with _LOCK:
+        for name in _LOADERS:
+            try:
+                _load(name)
+            except Exception as e:
+                print("error loading {} model: {}".format(name, e))
+
+
+def get_model(name):
+    """
+    Shared model instance, reloaded first if its file changed on disk
+    :param name: str
+        'classification' or 'regression'
+    :return: model
+        loaded model ready for predict
+    """
+    with _LOCK:
+        entry = _MODELS.get(name)
+        if entry is None or os.path.getmtime(entry['path']) != entry['mtime']:
+            _load(name)
+        return _MODELS[name]['model']
+
+
+def model_info():
+    """
+    Load time and memory footprint of the loaded models
+    :return: dict
+        name -> path, modified time, load seconds and size in bytes
+    """
+    with _LOCK:
+        return {name: {key: value for key, value in entry.items() if key != 'model'}
+                for name, entry in _MODELS.items()}
+
+
+def model_version():
+    """
+    Version of the model files on disk, changes whenever a model file is replaced
+    :return: str
+        hash of the path, size and modified time of every model file
+    """
+    version = hashlib.sha256()
+    for name, (path, _) in sorted(_LOADERS.items()):
+        stat = os.stat(path)
+        version.update('{}:{}:{}:{};'.format(name, path, stat.st_size, stat.st_mtime_ns).encode())
+    return version.hexdigest()
@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Numeric, DateTime
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Numeric, DateTime, Float, Index, LargeBinary
 from sqlalchemy.orm import relationship
 
 from database import Base
@@ -7,17 +7,66 @@ from database import Base
 SQLite3 molels
 """
 
+# subject and session of rows uploaded without one
+DEFAULT_SUBJECT = 'default'
+DEFAULT_SESSION = 'default'
+
 class Acti(Base):
     __tablename__ = "acti"
+    __table_args__ = (
+        # time range of a subject's session is an index seek
+        Index('ix_acti_subject_session_timestamp', 'subject', 'session', 'timestamp'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
+    subject = Column(String, nullable=False, default=DEFAULT_SUBJECT, server_default=DEFAULT_SUBJECT)
+    session = Column(String, nullable=False, default=DEFAULT_SESSION, server_default=DEFAULT_SESSION)
     timestamp = Column(DateTime)
     mets = Column(Numeric(4, 2))
 
 class Wrist(Base):
     __tablename__ = "wrist"
+    __table_args__ = (
+        # time range of a subject's session is an index seek
+        Index('ix_wrist_subject_session_timestamp', 'subject', 'session', 'timestamp'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
+    subject = Column(String, nullable=False, default=DEFAULT_SUBJECT, server_default=DEFAULT_SUBJECT)
+    session = Column(String, nullable=False, default=DEFAULT_SESSION, server_default=DEFAULT_SESSION)
     timestamp = Column(DateTime)
     mets = Column(Numeric(4, 2))
+    provisional = Column(Boolean, nullable=False, default=False, server_default='0')  # quick estimate, replaced by the full result
+    job_id = Column(Integer)  # job that wrote the row
+
+class DataVersion(Base):
+    __tablename__ = "data_version"
+
+    id = Column(Integer, primary_key=True)  # single row, id 1
+    version = Column(Integer, nullable=False, default=0)  # bumped whenever acti or wrist rows change
+
+class Job(Base):
+    __tablename__ = "job"
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String)
+    status = Column(String, index=True)  # queued, running, done, failed
+    progress = Column(Float, default=0.0)
+    message = Column(String)
+    files = Column(String)  # json list of the saved uploads
+    options = Column(String)  # json dict of processing options
+    pid = Column(Integer)  # pool process running the job
+    owner = Column(String)  # jobs.process_identity of the process saving or running the job
+    recording = Column(String, index=True)  # feature_store key of the uploaded files
+    created = Column(DateTime)
+    updated = Column(DateTime)
+
+class WristSession(Base):
+    __tablename__ = "wrist_session"
 
+    subject = Column(String, primary_key=True)
+    session = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=1)  # bumped on every update, compared before replacing the state
+    state = Column(LargeBinary)  # pickled incremental.IncrementalWrist
+    next_minute = Column(DateTime)  # first minute not estimated yet
+    updated = Column(DateTime)
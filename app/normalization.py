@@ -0,0 +1,88 @@
+import numpy as np
+
+"""
+Min-max rescaling of sensor columns to the range of the training data.
+Arrays are processed in blocks of rows that stay in cache: the statistics of all columns are
+gathered in one pass and the rescaling is written in place, no column copies are made.
+The statistics can also be gathered chunk by chunk while streaming and the rescaling applied later.
+"""
+
+BLOCK_ROWS = 32768  # rows per block, a few MB for 3 float64 columns
+
+
+class MinMaxStats:
+    """
+    Running nan-aware minimum and maximum of each column
+
+    >>> stats = MinMaxStats(3)
+    >>> for chunk in chunks:
+    ...     stats.update(chunk)
+    >>> rescale_min_max(values, stats.minimum, stats.maximum, target_max, target_min)
+    """
+
+    def __init__(self, columns):
+        self.minimum = np.full(columns, np.nan)
+        self.maximum = np.full(columns, np.nan)
+
+    def update(self, values, block_rows=BLOCK_ROWS):
+        """
+        Add (rows, columns) values, nan values are skipped like the pandas min/max of a column
+        """
+        values = np.asarray(values)
+        for start in range(0, len(values), block_rows):
+            block = values[start:start + block_rows]
+            # both reductions run on the block while it is in cache
+            self.minimum = np.fmin(self.minimum, np.fmin.reduce(block, axis=0))
+            self.maximum = np.fmax(self.maximum, np.fmax.reduce(block, axis=0))
+        return self
+
+
+def column_min_max(values, block_rows=BLOCK_ROWS):
+    """
+    Minimum and maximum of every column in one pass over the rows
+    :param values: np.array
+        (rows, columns) values
+    :return: minimum, maximum: np.array
+        nan-aware minimum and maximum of each column
+    """
+    stats = MinMaxStats(np.shape(values)[1]).update(values, block_rows)
+    return stats.minimum, stats.maximum
+
+
+def rescale_min_max(values, minimum, maximum, target_max, target_min, block_rows=BLOCK_ROWS):
+    """
+    Rescale each column in place from [minimum, maximum] to [target_min, target_max]
+    Same values as (target_max - target_min) / (maximum - minimum) * (value - maximum) + target_max per column.
+    :param values: np.array
+        (rows, columns) float array, C contiguous, overwritten
+    :param minimum, maximum: np.array
+        current range of each column
+    :param target_max, target_min: np.array
+        range of each column after rescaling
+    :return: np.array
+        values
+    """
+    maximum = np.asarray(maximum, dtype=float)
+    target_max = np.asarray(target_max, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):  # a constant column gives inf/nan like pandas
+        scale = (target_max - np.asarray(target_min, dtype=float)) / (maximum - np.asarray(minimum, dtype=float))
+        for start in range(0, len(values), block_rows):
+            block = values[start:start + block_rows]
+            np.subtract(block, maximum, out=block)
+            np.multiply(block, scale, out=block)
+            np.add(block, target_max, out=block)
+    return values
+
+
+def normalize_min_max(values, target_max, target_min, block_rows=BLOCK_ROWS):
+    """
+    Rescale each column in place to [target_min, target_max] using its own minimum and maximum
+    :param values: np.array
+        (rows, columns) float array, C contiguous, overwritten
+    :param target_max, target_min: np.array
+        range of each column after rescaling
+    :return: np.array
+        values
+    """
+    minimum, maximum = column_min_max(values, block_rows)
+    return rescale_min_max(values, minimum, maximum, target_max, target_min, block_rows)
@@ -0,0 +1,128 @@
+import numpy as np
+import pandas as pd
+from sqlalchemy import select
+from database import engine
+from models import DataVersion, DEFAULT_SUBJECT, DEFAULT_SESSION
+
+"""
+Bulk writes of minute mets results.
+Rows are inserted with executemany in batches inside a single transaction,
+instead of the row by row pandas to_sql path.
+Every change of the mets bumps the data version, so caches of derived data know when to rebuild.
+"""
+
+BATCH_SIZE = 5000  # rows per executemany call
+
+
+def mets_rows(df, subject=DEFAULT_SUBJECT, session=DEFAULT_SESSION, **columns):
+    """
+    Insert parameters of a minute mets data frame
+    :param df: data frame
+        timestamp and mets columns
+    :param subject, session: str
+        keys of the rows
+    :param columns:
+        other column values shared by every row, e.g. provisional=True
+    :return: list
+        one {'subject', 'session', 'timestamp', 'mets', ...} dict per row, missing values as None
+    """
+    timestamps = pd.to_datetime(df['timestamp'])
+    timestamps = timestamps.dt.to_pydatetime() if hasattr(timestamps, 'dt') else timestamps.to_pydatetime()
+    mets = np.asarray(df['mets'], dtype=float)
+    return [dict(columns, subject=subject, session=session,
+                 timestamp=None if pd.isnull(timestamp) else timestamp,
+                 mets=None if np.isnan(met) else met)
+            for timestamp, met in zip(timestamps, mets.tolist())]
+
+
+def insert_mets(connection, table, df, subject=DEFAULT_SUBJECT, session=DEFAULT_SESSION, **columns):
+    """
+    Insert minute mets on an open connection, part of the caller's transaction
+    :param connection: connection
+        sqlalchemy connection, usually from engine.begin()
+    :param table: Table
+        Acti.__table__ or Wrist.__table__
+    :param df: data frame
+        timestamp and mets columns
+    :param subject, session: str
+        keys of the rows
+    :param columns:
+        other column values shared by every row
+    :return: int
+        number of rows inserted
+    """
+    rows = mets_rows(df, subject, session, **columns)
+    statement = table.insert()
+    for start in range(0, len(rows), BATCH_SIZE):
+        connection.execute(statement, rows[start:start + BATCH_SIZE])
+    bump_data_version(connection)
+    return len(rows)
+
+
+def save_mets(table, df, subject=DEFAULT_SUBJECT, session=DEFAULT_SESSION):
+    """
+    Insert minute mets in one transaction
+    :param table: Table
+        Acti.__table__ or Wrist.__table__
+    :param df: data frame
+        timestamp and mets columns
+    :param subject, session: str
+        keys of the rows
+    :return: int
+        number of rows inserted
+    """
+    with engine.begin() as connection:
+        return insert_mets(connection, table, df, subject, session)
+
+
+def bump_data_version(connection):
+    """
+    Mark the acti/wrist data as changed, part of the caller's transaction
+    :param connection: connection
+        sqlalchemy connection (or orm session) in the transaction changing the data
+    """
+    table = DataVersion.__table__
+    result = connection.execute(table.update().where(table.c.id == 1).values(version=table.c.version + 1))
+    if result.rowcount == 0:
+        connection.execute(table.insert().values(id=1, version=1))
+
+
+def data_version():
+    """
+    Current data version, changes on every insert or delete of mets
+    :return: int
+        0 before any data was written
+    """
+    table = DataVersion.__table__
+    with engine.connect() as connection:
+        version = connection.execute(select([table.c.version]).where(table.c.id == 1)).scalar()
+    return version or 0
+
+
+def session_filter(query, model, subject=None, session=None, start=None, end=None):
+    """
+    Restrict a query to the rows of a subject's session in a time range,
+    a seek on the (subject, session, timestamp) index when both are given
+    :param query: query
+        sqlalchemy query on model
+    :param model: class
+        Acti or Wrist
+    :param subject: str
+        subject to read, None keeps every subject
+    :param session: str
+        session to read, None keeps every session
+    :param start, end: datetime
+        optional time range [start, end), only with a session
+    :return: query
+        filtered query ordered by timestamp when a session is given
+    """
+    if subject is not None:
+        query = query.filter(model.subject == subject)
+    if session is None:
+        return query
+    query = query.filter(model.session == session)
+    if start is not None:
+        query = query.filter(model.timestamp >= start)
+    if end is not None:
+        query = query.filter(model.timestamp < end)
+    return query.order_by(model.timestamp)
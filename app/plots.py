@@ -0,0 +1,180 @@
+import json
+import threading
+from collections import OrderedDict
+import numpy as np
+import queries
+from persistence import data_version
+
+"""
+Data of the dashboard plots.
+The MET comparison, the MET trends and the cumulative kcal are computed with NumPy from the stored
+minute mets and returned as compact plotly.js figures (traces and layout only), the browser renders them.
+Long recordings can be downsampled with LTTB before they are sent.
+The serialized figures are cached per data version, they are only rebuilt after mets are inserted or cleared.
+"""
+
+WEIGHT_KG = 94.5  # weight of the subject for kcal
+# plotly_white look, the template itself lives in plotly.py and is not sent
+LAYOUT = {'paper_bgcolor': 'white', 'plot_bgcolor': 'white',
+          'xaxis': {'gridcolor': '#EBF0F8', 'zerolinecolor': '#EBF0F8'},
+          'yaxis': {'gridcolor': '#EBF0F8', 'zerolinecolor': '#EBF0F8'}}
+CACHE_SIZE = 16  # serialized figure sets kept per process
+
+_CACHE_LOCK = threading.Lock()
+_CACHE = OrderedDict()  # (data version, subject, session, max_points, weight) -> json, least recently used first
+
+
+def lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling
+    :param x: np.array
+        ascending x values
+    :param y: np.array
+        y values, finite
+    :param threshold: int
+        number of points to keep
+    :return: np.array
+        indices of the points kept, the first and last point are always kept
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    # points 1..n-2 are split in threshold-2 buckets, one point is kept per bucket
+    bounds = np.arange(threshold - 1) * (n - 2) // (threshold - 2) + 1
+    bounds = np.append(bounds, n)
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0] = 0
+    kept[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = bounds[i], bounds[i + 1]
+        # the third corner is the average of the next bucket (the last point for the last bucket)
+        next_x = x[end:bounds[i + 2]].mean()
+        next_y = y[end:bounds[i + 2]].mean()
+        area = np.abs((x[a] - next_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (next_y - y[a]))
+        a = start + int(np.argmax(area))
+        kept[i + 1] = a
+    return kept
+
+
+def _downsample(timestamps, values, max_points):
+    # LTTB on the finite points, all points when max_points is None
+    if max_points is None or len(values) <= max_points:
+        return timestamps, values
+    finite = np.flatnonzero(np.isfinite(values))
+    kept = finite[lttb(timestamps[finite].astype(np.int64), values[finite], max_points)]
+    return timestamps[kept], values[kept]
+
+
+def _times(timestamps):
+    return np.datetime_as_string(timestamps, unit='s').tolist()
+
+
+def _values(values):
+    # json has no nan, missing values are null
+    return [None if np.isnan(value) else value for value in np.round(values, 4).tolist()]
+
+
+def cumulative_kcal(mets, weight_kg=WEIGHT_KG):
+    """
+    Cumulative kcal of minute mets
+    :param mets: np.array
+        minute mets, nan for missing minutes
+    :param weight_kg: float
+        weight of the subject
+    :return: np.array
+        running kcal total, nan where the mets are missing like pandas cumsum
+    """
+    kcal = mets * 3.5 * float(weight_kg) / 200
+    total = np.nancumsum(kcal)
+    total[np.isnan(kcal)] = np.nan
+    return total
+
+
+def figures(subject=None, session=None, max_points=None, weight_kg=WEIGHT_KG):
+    """
+    The three dashboard figures as plotly.js json
+    :param subject: str
+        subject to plot, None plots every subject
+    :param session: str
+        session to plot, None plots every session
+    :param max_points: int
+        optional, most points per trace, longer traces are downsampled with LTTB
+    :param weight_kg: float
+        weight of the subject for kcal
+    :return: dict
+        plot1 (MET comparison), plot2 (MET trends), plot3 (cumulative kcal), each {'data', 'layout'}
+    """
+    acti_time, acti_mets = queries.read_series('acti', subject, session)
+    wrist_time, wrist_mets = queries.read_series('wrist', subject, session)
+
+    # Figure 1: Proposed vs ActiGraph METs, paired minute by minute in storage order
+    n = min(len(acti_mets), len(wrist_mets))
+    pairs = np.arange(n)
+    if max_points is not None and n > max_points:
+        pairs = np.linspace(0, n - 1, max_points).astype(np.int64)
+    plot1 = {'data': [{'type': 'scatter', 'mode': 'markers', 'name': 'METs',
+                       'x': _values(acti_mets[pairs]), 'y': _values(wrist_mets[pairs])}],
+             'layout': dict(LAYOUT, title={'text': 'MET Comparison: Proposed vs ActiGraph'},
+                            xaxis=dict(LAYOUT['xaxis'], title={'text': 'MET (ActiGraph)'}),
+                            yaxis=dict(LAYOUT['yaxis'], title={'text': 'MET (Proposed)'}))}
+
+    # Figure 2: METs trend over timestamp
+    traces = []
+    for name, timestamps, mets in (('ActiGraph MET', acti_time, acti_mets), ('Proposed/Wrist MET', wrist_time, wrist_mets)):
+        timestamps, mets = _downsample(timestamps, mets, max_points)
+        traces.append({'type': 'scatter', 'mode': 'lines+markers', 'name': name,
+                       'x': _times(timestamps), 'y': _values(mets)})
+    plot2 = {'data': traces,
+             'layout': dict(LAYOUT, title={'text': 'METs Trend: ActiGraph vs. Proposed'},
+                            xaxis=dict(LAYOUT['xaxis'], title={'text': 'Time'}),
+                            yaxis=dict(LAYOUT['yaxis'], title={'text': 'METs'}),
+                            legend={'x': 0, 'y': 1.1, 'orientation': 'h'})}
+
+    # Figure 3: cumulative kCal over timestamp, with the final total of each device
+    traces = []
+    annotations = []
+    for name, timestamps, mets, color in (('ActiGraph Cumulative kCal', acti_time, acti_mets, 'blue'),
+                                          ('Proposed Cumulative kCal', wrist_time, wrist_mets, 'green')):
+        total = cumulative_kcal(mets, weight_kg)
+        if len(total):
+            annotations.append({'x': _times(timestamps[-1:])[0], 'y': _values(total[-1:])[0],
+                                'text': '{:.1f} kcal'.format(total[-1]), 'showarrow': True, 'arrowhead': 2,
+                                'ax': 0, 'ay': -20, 'font': {'color': color}})
+        timestamps, total = _downsample(timestamps, total, max_points)
+        traces.append({'type': 'scatter', 'mode': 'lines+markers', 'name': name,
+                       'x': _times(timestamps), 'y': _values(total)})
+    plot3 = {'data': traces,
+             'layout': dict(LAYOUT, title={'text': 'Cumulative Energy Expenditure Over Time'},
+                            xaxis=dict(LAYOUT['xaxis'], title={'text': 'Time'}),
+                            yaxis=dict(LAYOUT['yaxis'], title={'text': 'Cumulative kCal'}),
+                            legend={'x': 0, 'y': 1.1, 'orientation': 'h'}, annotations=annotations)}
+
+    return {'plot1': plot1, 'plot2': plot2, 'plot3': plot3}
+
+
+def cached_figures(subject=None, session=None, max_points=None, weight_kg=WEIGHT_KG):
+    """
+    figures() serialized to json, reused until the data version changes
+    :return: bytes
+        json of the three figures
+    """
+    # the version is read before the data, an insert in between only makes the entry newer than its key
+    key = (data_version(), subject, session, max_points, weight_kg)
+    with _CACHE_LOCK:
+        if key in _CACHE:
+            _CACHE.move_to_end(key)
+            return _CACHE[key]
+
+    payload = json.dumps(figures(subject, session, max_points, weight_kg), separators=(',', ':')).encode()
+    with _CACHE_LOCK:
+        _CACHE[key] = payload
+        # entries of older versions are never asked for again
+        for old in [old for old in _CACHE if old[0] < key[0]]:
+            del _CACHE[old]
+        while len(_CACHE) > CACHE_SIZE:
+            _CACHE.popitem(last=False)
+    return payload
@@ -1,12 +1,28 @@
-import joblib
 import numpy as np
 import pandas as pd
 from datetime import timedelta
-from util import time_parameters, process_wrist, get_freq_intensity, get_rmssd, get_train_data, extract_features, resample
-from xgboost import XGBClassifier
-from support_functions import get_intensity#, extract_features
+from util import process_wrist, extract_features, resample
+from support_functions import get_intensity, get_intensity_batch#, extract_features
+from model_registry import get_model
+from segmentation import sort_by_datetime, minute_starts, minute_bounds, minute_array, stack_minutes
+from features import CHUNK_MINUTES, FEATURE_WORKERS, parallel_minute_features
+from normalization import normalize_min_max, rescale_min_max
+import feature_store
+from ingest import CHUNK_SIZE, WristStream, rewind, wrist_sensor
 
 DATA_LENGTH = 1200
+WINDOW_SIZE = 60  # seconds per window
+STREAM_MINUTES = 240  # minutes held at a time by process_wrist_stream
+ACC_COLUMNS = ['accX', 'accY', 'accZ']
+GYRO_COLUMNS = ['rotX', 'rotY', 'rotZ']
+# max and min of each accelerometer column in the original training data
+ACC_MIN_MAX = {'accX': [38.03060682003315, -33.763857951531044],
+               'accY': [34.77019433156978, -43.30149280531167],
+               'accZ': [37.98169060088745, -36.9844767541086]}
+ACC_TARGET_MAX = np.array([ACC_MIN_MAX[col][0] for col in ACC_COLUMNS])
+ACC_TARGET_MIN = np.array([ACC_MIN_MAX[col][1] for col in ACC_COLUMNS])
+# Need Demographic info, the same subject is assumed for every upload
+DEMOGRAPHICS = {'gender': 1.0, 'age': 34, 'BMI': 36}
 WRIST_DATA = []
 
 
@@ -14,21 +30,59 @@ def upload_single_wrist(wrist_df):
     WRIST_DATA.append(wrist_df)
 
 
-def process_wrist_data(wrist_data):
+def process_wrist_files(wrist_files, stream=False, progress=None, workers=FEATURE_WORKERS, recording=None,
+                        accel_only=False):
+    """
+    Process uploaded wrist csv files, gyro and accelerometer
+    :param wrist_files: list
+        csv file objects or paths
+    :param stream: bool
+        read the files in chunks instead of loading them whole
+    :param progress: function
+        optional, called with the fraction of the work done
+    :param workers: int
+        processes used for the feature extraction
+    :param recording: str
+        optional feature_store key, the minute features are stored under it
+    :param accel_only: bool
+        fast mode, estimate from the accelerometer file only (process_wrist_accel), the gyro file is not read
+    :return: dataframe
+        minute met estimate, 1 on error like process_wrist_data
+    """
+    if accel_only:
+        accel_files = [wrist_file for wrist_file in wrist_files if wrist_sensor(wrist_file) == 'accel']
+        if len(accel_files) != 1:
+            print("Incorrect wrist files")
+            return 1
+        df_wrist = resample(pd.read_csv(accel_files[0], index_col=None, header=0), 'Time', 20, 100)
+        return process_wrist_accel(process_wrist(df_wrist))
+
+    if stream:
+        return process_wrist_stream(wrist_files, workers=workers, recording=recording)
+
+    data_list = []  # hold dataframe from gyro and accl wrist csv file
+    for wrist_file in wrist_files:
+        # find and load gyro and accel files, then resample to 20hz
+        df_wrist_og = pd.read_csv(wrist_file, index_col=None, header=0)
+        df_wrist = resample(df_wrist_og, 'Time', 20, 100)
+        data_list.append(process_wrist(df_wrist))
+        if progress is not None:
+            progress(0.5 * len(data_list) / len(wrist_files))
+    return process_wrist_data(data_list, workers, recording)
+
+
+def process_wrist_data(wrist_data, workers=FEATURE_WORKERS, recording=None):
     """
     Process the wrist data from input files
     :param wrist_data: list dataframe
         gyro and acceleromtere dataframe from input csv files
+    :param workers: int
+        processes used for the feature extraction, chunks of minutes are processed in parallel
+    :param recording: str
+        optional feature_store key, the minute features are stored under it
     :return: dataframe
         process and minute met estimate from wrist worn device using preloaded model
     """
-    # load the pre-trained model
-    # classification model
-    model_classification = XGBClassifier()
-    model_classification.load_model("./classification_model.json")
-    # regression model
-    loaded_rf = joblib.load("./regression_model.joblib")
-
     if len(wrist_data) != 2:  # not two files uploaded
         print("Incorrect file count")
         # TODO: log error, alert user in api get
@@ -55,79 +109,260 @@ def process_wrist_data(wrist_data):
     df_acc = process_wrist(df_acc_resampled)
     df_gyro = process_wrist(df_gyro_resampled)
 
-    # normalize each column to match the scale from original data
-    targets = ['accX', 'accY', 'accZ']
-    min_max = {'accX': [38.03060682003315, -33.763857951531044],
-               'accY': [34.77019433156978, -43.30149280531167],
-               'accZ': [37.98169060088745, -36.9844767541086]}
-
-    for each_col in targets:
-        max_old = np.max(df_acc[each_col])
-        min_old = np.min(df_acc[each_col])
-        value = df_acc[each_col]
-        max_acc = min_max[each_col][0]
-        min_acc = min_max[each_col][1]
-        df_acc[each_col] = (max_acc - min_acc) / (max_old - min_old) * (value - max_old) + max_acc
-
     # segmentation and feature extraction
     st_ceil, et_floor = time_parameters(df_gyro)  # get start and end time of gyroscope
 
-    window_size = 60
-    minute_wrist = []
-    l_intensity_freq = []
-    l_intensity_rmssd_l1 = []
-    data_training = []
+    n_minutes = count_minutes(st_ceil, et_floor)
 
-    start_time = st_ceil
+    # find the rows of every minute once
+    df_acc = sort_by_datetime(df_acc)
+    df_gyro = sort_by_datetime(df_gyro)
+    minute_wrist = list(minute_starts(st_ceil, n_minutes))
+    acc_bounds = minute_bounds(df_acc, st_ceil, n_minutes, WINDOW_SIZE)
+    gyro_bounds = minute_bounds(df_gyro, st_ceil, n_minutes, WINDOW_SIZE)
 
-    # Examine each minute
-    for i in range(int((et_floor - st_ceil).seconds / 60)):
-        minute_wrist.append(start_time)
-        end_time = start_time + pd.DateOffset(minutes=1)
+    # normalize each column to match the scale from original data, in place on one (rows, 3) copy
+    acc_values = np.array(df_acc[ACC_COLUMNS].values, dtype=float, order='C')
+    normalize_min_max(acc_values, ACC_TARGET_MAX, ACC_TARGET_MIN)
 
-        temp = df_acc.loc[(df_acc['Datetime'] >= start_time) & (df_acc['Datetime'] < end_time)].reset_index(drop=True)
-        l_intensity_freq.append(get_freq_intensity(temp, 100, 1, False))
-        l_intensity_rmssd_l1.append(get_rmssd(temp, norm='l1'))
+    return estimate_minutes(minute_wrist, acc_values, acc_bounds, df_gyro[GYRO_COLUMNS].values, gyro_bounds,
+                            workers, recording)
 
-        data_training.append(
-            get_train_data(df_gyro, start_time, window_size, 'gyro') + get_train_data(df_acc, start_time, window_size,
-                                                                                      'acc'))
-        start_time += pd.DateOffset(minutes=1)
 
-    for i in range(len(data_training)):
-        for j in range(6):
-            if (data_training[i][j].shape[0] != window_size * 20):
-                s_temp = pd.Series([0] * int(window_size * 20 - data_training[i][j].shape[0]))
-                data_training[i][j] = pd.concat([data_training[i][j], s_temp], ignore_index=True)
+def process_wrist_accel(df_accel):
+    """
+    Fast accelerometer only estimate, no gyroscope and no classification model
+    Minutes follow the accelerometer recording and the mets come from model_estimate_accl_batch,
+    bounded by set_realistic_met_estimates_batch for an unknown class.
+    :param df_accel: dataframe
+        accelerometer dataframe from the input csv, with Time and Datetime
+    :return: dataframe
+        minute met estimate, 1 on error
+    """
+    if df_accel is None or df_accel.empty or 'accX' not in df_accel.columns:
+        print("error in missing data frame")
+        return 1
+
+    df_acc = process_wrist(resample(df_accel[['Time'] + ACC_COLUMNS], 'Time', 20))
+    st_ceil, et_floor = time_parameters(df_acc)
+    n_minutes = count_minutes(st_ceil, et_floor)
+
+    df_acc = sort_by_datetime(df_acc)
+    minute_wrist = list(minute_starts(st_ceil, n_minutes))
+    acc_bounds = minute_bounds(df_acc, st_ceil, n_minutes, WINDOW_SIZE)
+    acc_values = np.array(df_acc[ACC_COLUMNS].values, dtype=float, order='C')
+    normalize_min_max(acc_values, ACC_TARGET_MAX, ACC_TARGET_MIN)
 
-    np_training = np.array(data_training)
-    data_train = extract_features(np_training)
+    estimation = model_estimate_accl_batch(acc_values, acc_bounds)
+    estimation = set_realistic_met_estimates_batch(np.full(len(estimation), -1), estimation)
+    return pd.DataFrame({'timestamp': minute_wrist, 'mets': estimation})
+
+
+def process_wrist_stream(wrist_files, chunksize=CHUNK_SIZE, workers=FEATURE_WORKERS, recording=None,
+                         batch_minutes=STREAM_MINUTES):
+    """
+    Process wrist csv uploads in chunks, same result as resampling each file and calling process_wrist_data
+    The files are read twice: the first pass finds the minutes to examine and the accelerometer range,
+    the second computes the features batch_minutes at a time. Memory is bounded by a csv chunk and a
+    batch of minutes, only the features of each minute are kept for the whole recording.
+    Local time repeating an hour (end of daylight saving) is not merged into the minutes already processed,
+    the repeated samples are dropped.
+    :param wrist_files: list
+        gyro and accelerometer csv paths or seekable file objects
+    :param chunksize: int
+        csv rows read at a time
+    :param workers: int
+        processes used for the feature extraction
+    :param recording: str
+        optional feature_store key, the minute features are stored under it
+    :param batch_minutes: int
+        minutes whose samples are held at a time
+    :return: dataframe
+        minute met estimate from wrist worn device using preloaded model
+    """
+    sensors = {wrist_sensor(wrist_file): wrist_file for wrist_file in wrist_files}
+    if len(wrist_files) != 2 or set(sensors) != {'accel', 'gyro'}:
+        print("Incorrect wrist files")
+        # TODO: log error, alert user in api get
+        return 1
+
+    # first pass, the first and last gyroscope samples set the minutes to examine
+    gyro = WristStream(sensors['gyro'], GYRO_COLUMNS, chunksize).scan()
+    if gyro.first_datetime is None:
+        print("error in missing data frame")
+        # TODO: log error, alert user in api get
+        return 1
+    st_ceil, et_floor = time_parameters(pd.DataFrame({'Datetime': [gyro.first_datetime, gyro.last_datetime]}))
+    minute_wrist = list(minute_starts(st_ceil, count_minutes(st_ceil, et_floor)))
+    if not minute_wrist:
+        return estimate_minutes(minute_wrist, None, None, None, None)
+
+    # the accelerometer range for the normalization and its longest minute, so every batch pads its windows alike
+    acc = WristStream(sensors['accel'], ACC_COLUMNS, chunksize)
+    acc_lengths = {}
+    for minute, values in acc:
+        acc_lengths[minute] = acc_lengths.get(minute, 0) + len(values)
+    acc_length = max(acc_lengths.get(minute, 0) for minute in minute_wrist)
+
+    # second pass, both sensors a batch of minutes at a time
+    batch_minutes = max(batch_minutes, CHUNK_MINUTES * workers)
+    gyro_batches = _minute_batches(WristStream(rewind(sensors['gyro']), GYRO_COLUMNS, chunksize),
+                                   minute_wrist, batch_minutes)
+    acc_batches = _minute_batches(WristStream(rewind(sensors['accel']), ACC_COLUMNS, chunksize),
+                                  minute_wrist, batch_minutes)
+    features = []
+    for (batch, gyro_windows), (_, acc_windows) in zip(gyro_batches, acc_batches):
+        acc_values, acc_bounds = stack_minutes(acc_windows, batch, 3)
+        gyro_values, gyro_bounds = stack_minutes(gyro_windows, batch, 3, np.float32)
+
+        # normalize each column to match the scale from original data, with the min/max of the first pass
+        rescale_min_max(acc_values, acc.minimum, acc.maximum, ACC_TARGET_MAX, ACC_TARGET_MIN)
+        features.append(parallel_minute_features(acc_values, acc_bounds, gyro_values, gyro_bounds,
+                                                 WINDOW_SIZE * 20, workers, acc_length=acc_length))
+
+    l_intensity_freq, l_intensity_rmssd_l1, data_train = (np.concatenate(parts) for parts in zip(*features))
+    if recording is not None:
+        feature_store.save(recording, minute_wrist, l_intensity_freq, l_intensity_rmssd_l1, data_train)
+    return infer_minutes(minute_wrist, l_intensity_freq, l_intensity_rmssd_l1, data_train)
+
+
+def _minute_batches(minutes, minute_wrist, batch_minutes):
+    """
+    Samples of consecutive batches of minute_wrist from a stream of (minute start, values)
+    :return: generator
+        (minute starts of the batch, dict minute start -> values), minutes outside minute_wrist are skipped
+    """
+    minutes = iter(minutes)
+    pending = next(minutes, None)
+    for start in range(0, len(minute_wrist), batch_minutes):
+        batch = minute_wrist[start:start + batch_minutes]
+        wanted = set(batch)
+        windows = {}
+        while pending is not None and pending[0] <= batch[-1]:
+            minute, values = pending
+            if minute in wanted:
+                windows[minute] = np.concatenate([windows[minute], values]) if minute in windows else values
+            pending = next(minutes, None)
+        yield batch, windows
+
+
+def estimate_minutes(minute_wrist, acc_values, acc_bounds, gyro_values, gyro_bounds, workers=FEATURE_WORKERS,
+                     recording=None):
+    """
+    Feature extraction, classification and regression of the minute windows
+    :param minute_wrist: list
+        start time of each minute
+    :param acc_values: np.array
+        (rows, 3) normalized accX, accY, accZ
+    :param acc_bounds: tuple
+        starts, ends rows of each minute in acc_values
+    :param gyro_values: np.array
+        (rows, 3) rotX, rotY, rotZ
+    :param gyro_bounds: tuple
+        starts, ends rows of each minute in gyro_values
+    :param workers: int
+        processes used for the feature extraction
+    :param recording: str
+        optional feature_store key, the minute features are stored under it
+    :return: dataframe
+        minute met estimate
+    """
+    if not len(minute_wrist):  # recording shorter than its first whole minute
+        print("Done Processing Wrist")
+        return pd.DataFrame({'timestamp': pd.to_datetime([]), 'mets': np.array([], dtype=float)})
+
+    # intensity and classification features of every minute
+    l_intensity_freq, l_intensity_rmssd_l1, data_train = parallel_minute_features(
+        acc_values, acc_bounds, gyro_values, gyro_bounds, WINDOW_SIZE * 20, workers)
+    if recording is not None:
+        feature_store.save(recording, minute_wrist, l_intensity_freq, l_intensity_rmssd_l1, data_train)
+
+    return infer_minutes(minute_wrist, l_intensity_freq, l_intensity_rmssd_l1, data_train)
+
+
+def infer_recording(recording):
+    """
+    Estimate the minute mets of a recording from its stored features, no resampling or feature extraction
+    :param recording: str
+        feature_store key
+    :return: dataframe
+        minute met estimate, None if the features of the recording are not stored
+    """
+    features = feature_store.load(recording)
+    if features is None:
+        return None
+    return infer_minutes(*features)
+
+
+def infer_minutes(minute_wrist, l_intensity_freq, l_intensity_rmssd_l1, data_train):
+    """
+    Classification and regression of the minute features
+    :param minute_wrist: list
+        start time of each minute
+    :param l_intensity_freq: np.array
+        frequency intensity of each minute
+    :param l_intensity_rmssd_l1: np.array
+        l1 RMSSD intensity of each minute
+    :param data_train: np.array
+        (minutes, features) extract_features vectors
+    :return: dataframe
+        minute met estimate
+    """
+    # pre-trained models, loaded once at startup and shared across requests
+    # classification model
+    model_classification = get_model('classification')
+    # regression model
+    loaded_rf = get_model('regression')
 
-    estimation = []
     # 1st stage classification
     classification = model_classification.predict(data_train)
 
-    # Need Demographic info
-    gender = 1.0
-    age = 34
-    BMI = 36
+    gender = DEMOGRAPHICS['gender']
+    age = DEMOGRAPHICS['age']
+    BMI = DEMOGRAPHICS['BMI']
 
-    # 2nd stage regression
-    for i in range(len(classification)):
-        if (classification[i] == 0):
-            estimation.append(1.0)
-        else:
-            # complete feature for regression model (TODO)
-            # 'gender', 'age', 'BMI', 'Intensity (Freq)', 'gender_age','gender_BMI','age_BMI','age_gender_BMI', 'Intensity (RMSSD_l1)'
-            feature_complete = [gender, age, BMI] + [l_intensity_freq[i]] + [gender * age, gender * BMI, age * BMI,
-                                                                             age * gender * BMI] + [
-                                   l_intensity_rmssd_l1[i]]
-            estimation.append(loaded_rf.predict(np.array(feature_complete).reshape(1, 9))[0])
+    # 2nd stage regression, sedentary minutes stay at 1.0 and all active minutes are predicted in one call
+    active = np.asarray(classification) != 0
+    estimation = np.ones(len(classification))
+    if active.any():
+        feature_complete = regression_features(np.asarray(l_intensity_freq)[active],
+                                               np.asarray(l_intensity_rmssd_l1)[active], gender, age, BMI)
+        estimation[active] = loaded_rf.predict(feature_complete)
 
     print("Done Processing Wrist")
     return pd.DataFrame({'timestamp':minute_wrist, 'mets':estimation})
 
 
+def regression_features(intensity_freq, intensity_rmssd_l1, gender, age, BMI):
+    """
+    Build the regression feature matrix for a batch of minutes
+    :param intensity_freq: np.array
+        frequency intensity of each minute
+    :param intensity_rmssd_l1: np.array
+        l1 RMSSD intensity of each minute
+    :param gender, age, BMI: float
+        demographic info of the subject
+    :return: np.array
+        (minutes, 9) features in the order the regression model was trained on:
+        'gender', 'age', 'BMI', 'Intensity (Freq)', 'gender_age','gender_BMI','age_BMI','age_gender_BMI', 'Intensity (RMSSD_l1)'
+    """
+    n = len(intensity_freq)
+    return np.column_stack([np.full(n, gender), np.full(n, age), np.full(n, BMI), intensity_freq,
+                            np.full(n, gender * age), np.full(n, gender * BMI), np.full(n, age * BMI),
+                            np.full(n, age * gender * BMI), intensity_rmssd_l1]).astype(float)
+
+
+def count_minutes(st_ceil, et_floor):
+    """
+    Number of whole minutes from st_ceil to et_floor, recordings of several days included
+    :param st_ceil, et_floor: timestamp
+        start and end from time_parameters
+    :return: int
+        minutes to examine, 0 when the recording ends before st_ceil
+    """
+    return max(0, int((et_floor - st_ceil) // pd.Timedelta(minutes=1)))
+
+
 def time_parameters(df):
     """
     Set start and end times for wrist data
@@ -169,6 +404,24 @@ def model_estimate_accl(df_accel, start_time, end_time):
     return model_estimation
 
 
+def model_estimate_accl_batch(acc_values, acc_bounds):
+    """
+    model_estimate_accl of every minute at once
+    :param acc_values: np.array
+        (rows, 3) accX, accY, accZ
+    :param acc_bounds: tuple
+        starts, ends rows of each minute in acc_values
+    :return: np.array
+        mets estimate of each minute, nan when more than a tenth of the minute is missing
+    """
+    starts, ends = acc_bounds
+    estimation = get_intensity_batch(minute_array(acc_values, acc_bounds, length=None)) * 0.39212 + 1.3
+    # nan accX samples in each minute, from a running count
+    missing = np.concatenate([[0], np.cumsum(np.isnan(acc_values[:, 0]))])
+    estimation[missing[ends] - missing[starts] > (DATA_LENGTH / 10)] = np.nan
+    return estimation
+
+
 def model_features_gyro(df_gyro, start_time, end_time):
     """
     Extract features from the gyro signal
@@ -213,3 +466,22 @@ def set_realistic_met_estimates(model_classification, model_estimation):
         if model_estimation < 1.5:
             model_estimation = 1.5
     return model_estimation
+
+
+def set_realistic_met_estimates_batch(model_classification, model_estimation):
+    """
+    set_realistic_met_estimates of every minute at once
+    :param model_classification: np.array
+        class of each minute, -1 when unknown
+    :param model_estimation: np.array
+        model estimation of each minute
+    :return: np.array
+        bounded mets estimate, nan stays nan
+    """
+    model_classification = np.asarray(model_classification)
+    estimation = np.array(model_estimation, dtype=float)
+    with np.errstate(invalid='ignore'):
+        estimation[(model_classification <= 0) & (estimation < 1)] = 1
+        estimation[(model_classification == 0) & (estimation > 1.5)] = 1.5
+        estimation[(model_classification == 1) & (estimation < 1.5)] = 1.5
+    return estimation
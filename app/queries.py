@@ -0,0 +1,138 @@
+import base64
+import numpy as np
+import pandas as pd
+from sqlalchemy import select, and_, or_, func, cast, literal_column, type_coerce, Float, Integer, String
+from database import engine
+from models import Acti, Wrist, DEFAULT_SUBJECT, DEFAULT_SESSION
+
+"""
+Column reads of the stored minute mets for the JSON API.
+Rows are read as plain (timestamp, mets) values straight from the (subject, session, timestamp) index,
+without building ORM objects, and returned a page at a time with a cursor to the next page.
+"""
+
+TABLES = {'acti': Acti.__table__, 'wrist': Wrist.__table__}
+DEFAULT_LIMIT = 1000
+MAX_LIMIT = 10000
+
+
+def _encode_cursor(*values):
+    return base64.urlsafe_b64encode('|'.join(str(value) for value in values).encode()).decode()
+
+
+def _decode_cursor(cursor):
+    try:
+        return base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError('invalid cursor')
+
+
+def read_mets(kind, subject=DEFAULT_SUBJECT, session=DEFAULT_SESSION, start=None, end=None, cursor=None,
+              limit=DEFAULT_LIMIT, resolution=None):
+    """
+    One page of the minute mets of a subject's session in a time range
+    :param kind: str
+        'acti' or 'wrist'
+    :param subject: str
+        subject to read
+    :param session: str
+        session to read
+    :param start, end: datetime
+        optional time range [start, end)
+    :param cursor: str
+        next_cursor of the previous page, None for the first page
+    :param limit: int
+        rows (or buckets) per page, at most MAX_LIMIT
+    :param resolution: int
+        optional bucket length in seconds, each bucket returns the mean, min and max mets of its minutes
+    :return: dict
+        timestamp and mets lists (plus min, max and count with a resolution) and next_cursor, None on the last page,
+        wrist pages also have a provisional list (quick estimates not yet replaced by the full result, a bucket is
+        provisional if any of its minutes is)
+    """
+    table = TABLES[kind]
+    limit = max(1, min(int(limit), MAX_LIMIT))
+    # timestamps are compared and returned as stored text, mets as floats instead of Decimal
+    timestamp = type_coerce(table.c.timestamp, String)
+    mets = type_coerce(table.c.mets, Float)
+
+    conditions = [table.c.subject == subject, table.c.session == session]
+    if start is not None:
+        conditions.append(table.c.timestamp >= start)
+    if end is not None:
+        conditions.append(table.c.timestamp < end)
+
+    if resolution:
+        return _read_buckets(table, timestamp, mets, conditions, cursor, limit, int(resolution))
+
+    if cursor is not None:
+        last_timestamp, last_id = _decode_cursor(cursor)
+        conditions.append(or_(timestamp > last_timestamp, and_(timestamp == last_timestamp, table.c.id > int(last_id))))
+    columns = [table.c.id, timestamp, mets]
+    if 'provisional' in table.c:
+        columns.append(table.c.provisional)
+    query = (select(columns).where(and_(*conditions))
+             .order_by(table.c.timestamp, table.c.id).limit(limit + 1))
+    with engine.connect() as connection:
+        rows = connection.execute(query).fetchall()
+
+    page = rows[:limit]
+    result = {'timestamp': [row[1] for row in page],
+              'mets': [row[2] for row in page],
+              'next_cursor': _encode_cursor(page[-1][1], page[-1][0]) if len(rows) > limit else None}
+    if 'provisional' in table.c:
+        result['provisional'] = [bool(row[3]) for row in page]
+    return result
+
+
+def _read_buckets(table, timestamp, mets, conditions, cursor, limit, resolution):
+    # buckets are aligned on multiples of resolution seconds, the cursor is the start of the next bucket
+    if cursor is not None:
+        conditions.append(timestamp >= _decode_cursor(cursor)[0])
+    bucket = (cast(func.strftime('%s', table.c.timestamp), Integer) / resolution * resolution).label('bucket')
+    columns = [func.datetime(bucket, literal_column("'unixepoch'")), func.avg(mets), func.min(mets),
+               func.max(mets), func.count(mets)]
+    if 'provisional' in table.c:
+        columns.append(func.max(table.c.provisional))
+    query = select(columns).where(and_(*conditions)).group_by(bucket).order_by(bucket).limit(limit + 1)
+    with engine.connect() as connection:
+        rows = connection.execute(query).fetchall()
+
+    page = rows[:limit]
+    result = {'timestamp': [row[0] for row in page],
+              'mets': [row[1] for row in page],
+              'min': [row[2] for row in page],
+              'max': [row[3] for row in page],
+              'count': [row[4] for row in page],
+              'next_cursor': _encode_cursor(rows[limit][0]) if len(rows) > limit else None}
+    if 'provisional' in table.c:
+        result['provisional'] = [bool(row[5]) for row in page]
+    return result
+
+
+def read_series(kind, subject=None, session=None):
+    """
+    All minute mets of a subject's session as arrays
+    :param kind: str
+        'acti' or 'wrist'
+    :param subject: str
+        subject to read, None reads every subject
+    :param session: str
+        session to read, None reads every session in insertion order
+    :return: timestamps, mets: np.array
+        datetime64 timestamps and float mets, missing mets as nan
+    """
+    table = TABLES[kind]
+    query = select([type_coerce(table.c.timestamp, String), type_coerce(table.c.mets, Float)])
+    if subject is not None:
+        query = query.where(table.c.subject == subject)
+    if session is None:
+        query = query.order_by(table.c.id)
+    else:
+        query = query.where(table.c.session == session).order_by(table.c.timestamp, table.c.id)
+    with engine.connect() as connection:
+        rows = connection.execute(query).fetchall()
+
+    timestamps = np.asarray(pd.to_datetime([row[0] for row in rows]), dtype='datetime64[ns]')
+    mets = np.array([row[1] for row in rows], dtype=float)  # None becomes nan
+    return timestamps, mets
@@ -0,0 +1,256 @@
+import numpy as np
+import pandas as pd
+
+
+def resample(dataDf, timeColHeader, samplingRate, gapTolerance=np.inf, fixedTimeColumn=None):
+    """
+    Parameters
+    ----------
+    dataDf : data dataframe, contains unixtime column and data column(s)
+
+    timeColHeader : string, time column header
+
+    samplingRate : int
+        Number of samples per second
+
+    gapTolerance: int(ms)
+        if the distance between target point and either of the neighbors is further than gapTolerance in millisecond,
+        then interpolation is nan
+        if gapTolerance=0, the gapTolerance rule will not exist
+
+    fixedTimeColumn:
+        optional array of unixtimes to sample at instead of the regular samplingRate grid
+
+    All columns are interpolated together with NumPy, the unixtime column is expected in ascending order.
+
+    Examples
+    --------
+    >>> timeColHeader = 'unixtime'
+    >>> df = pd.DataFrame(np.arange(20).reshape(5,4),
+                      columns=['unixtime', 'A', 'B', 'C'])
+
+    >>> unix = np.array([1500000000000,1500000000048,1500000000075,1500000000100,1500000000150])
+    >>> df['unixtime'] = unix
+    >>> print(df)
+            unixtime   A   B   C
+    0  1500000000000   1   2   3
+    1  1500000000048   5   6   7
+    2  1500000000075   9  10  11
+    3  1500000000100  13  14  15
+    4  1500000000150  17  18  19
+    >>> newSamplingRate = 20
+    >>> newDf = resample(df, timeColHeader, newSamplingRate)
+    >>> print(newDf)
+            unixtime          A          B          C
+    0  1500000000000   1.000000   2.000000   3.000000
+    1  1500000000050   5.296295   6.296295   7.296295
+    2  1500000000100  13.000000  14.000000  15.000000
+    3  1500000000150  17.000000  18.000000  19.000000
+
+    >>> newSamplingRate = 33
+    >>> newDf = resample(df, timeColHeader, newSamplingRate)
+    >>> print(newDf)
+            unixtime          A          B          C
+    0  1500000000000   1.000000   2.000000   3.000000
+    1  1500000000030   3.525238   4.525238   5.525238
+    2  1500000000060   6.867554   7.867554   8.867554
+    3  1500000000090  11.545441  12.545441  13.545441
+    4  1500000000121  14.696960  15.696960  16.696960
+
+    (Note: the 5th unixtime is 1500000000121 instead of 1500000000120, since 5th sampling is 121.21212121ms after 1st sampling.
+    """
+
+    originalNameOrder = list(dataDf.columns.values)
+
+    unixtimeArr = dataDf[timeColHeader].values
+    deltaT = 1000.0 / samplingRate
+
+    dataDf = dataDf.drop(timeColHeader, axis=1)
+    dataArr = dataDf.values
+    names = list(dataDf.columns.values)
+
+    n = len(unixtimeArr)
+
+    if n < 2:
+        return
+
+    if fixedTimeColumn is None:
+        # always take the first timestamp time[0], then step by deltaT until we pass the last timestamp
+        t = resample_grid(unixtimeArr[0], unixtimeArr[-1], deltaT)
+        newDataArr = np.empty((len(t) + 1, dataArr.shape[1]), dtype=float)
+        newDataArr[0] = dataArr[0]
+        newDataArr[1:] = interpolate_at(unixtimeArr, dataArr, t, gapTolerance, first_index=1)
+        newUnixtimeArr = np.concatenate([[unixtimeArr[0]], t.astype(np.int64)])
+    else:
+        fixedTimeColumn = np.asarray(fixedTimeColumn)
+        # sample each fixed time up to (and including) the first one past the last timestamp
+        pastEnd = fixedTimeColumn > unixtimeArr[-1]
+        stop = np.argmax(pastEnd) + 1 if pastEnd.any() else len(fixedTimeColumn)
+        t = fixedTimeColumn[:stop]
+        newDataArr = interpolate_at(unixtimeArr, dataArr, t, gapTolerance, first_index=0)
+        newUnixtimeArr = t.astype(np.int64)
+
+    dataDf = pd.DataFrame(data=newDataArr, columns=names)
+    dataDf[timeColHeader] = newUnixtimeArr
+
+    # change to the original column order
+    dataDf = dataDf[originalNameOrder]
+    return dataDf
+
+
+def resample_grid(start, end, deltaT, keepFirst=True):
+    """
+    Regular sampling times after start, stepping deltaT until end is passed
+    :param start: int
+        first unixtime (ms), not included in the output
+    :param end: int
+        last unixtime (ms)
+    :param deltaT: float
+        step between samples in ms
+    :param keepFirst: bool
+        keep the first sampling time even when it is past end
+    :return: np.array
+        float sampling times up to end
+    """
+    count = max(int((end - start) // deltaT) + 2, 1)
+    steps = np.full(count, deltaT)
+    steps[0] = start + deltaT
+    # accumulate step by step so the times round exactly like repeated t = t + deltaT
+    t = np.add.accumulate(steps)
+    return t[:max(np.searchsorted(t, end, side='right'), int(keepFirst))]
+
+
+def interpolate_at(unixtimeArr, dataArr, t, gapTolerance=np.inf, first_index=1):
+    """
+    Linear interpolation of every column of dataArr at the times t
+    :param unixtimeArr: np.array
+        ascending unixtimes of the original samples
+    :param dataArr: np.array
+        original samples, one row per unixtime
+    :param t: np.array
+        ascending times to interpolate at
+    :param gapTolerance: int(ms)
+        neighbors further apart than gapTolerance give nan, 0 disables the rule
+    :param first_index: int
+        smallest index allowed as right neighbor, samples right of index 0 give nan
+    :return: np.array
+        interpolated samples, shape (len(t), number of columns)
+    """
+    n = len(unixtimeArr)
+    if dataArr.ndim == 1:
+        dataArr = dataArr[:, None]
+
+    # right neighbor of each t, never moving backwards like the original forward search
+    tIndAfter = np.maximum.accumulate(np.maximum(np.searchsorted(unixtimeArr, t), first_index))
+    found = (tIndAfter > 0) & (tIndAfter < n)
+    after = np.clip(tIndAfter, 1, n - 1)
+    before = after - 1
+
+    t1 = unixtimeArr[before]
+    t2 = unixtimeArr[after]
+    valid = found & (t1 <= t) & (t <= t2)
+    if gapTolerance != 0:
+        valid &= np.abs(t1 - t2) <= gapTolerance
+
+    s1 = dataArr[before]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m = (dataArr[after] - s1).astype(float) / (t2 - t1)[:, None]
+        b = s1 - m * t1[:, None]
+        out = m * t[:, None] + b
+    out[~valid] = np.nan
+    return out
+
+
+class StreamingResampler:
+    """
+    Resample a signal that arrives in chunks, giving the same rows as resample() on the whole signal
+    Only the last original sample and the last sampling time are kept between chunks.
+
+    >>> resampler = StreamingResampler(20)
+    >>> for unixtimeArr, dataArr in chunks:
+    ...     newUnixtimeArr, newDataArr = resampler.push(unixtimeArr, dataArr)
+    >>> newUnixtimeArr, newDataArr = resampler.finish()
+    """
+
+    def __init__(self, samplingRate, gapTolerance=np.inf):
+        self.deltaT = 1000.0 / samplingRate
+        self.gapTolerance = gapTolerance
+        self.count = 0  # original samples seen
+        self.first = None  # first original sample (unixtime, samples), output once a second sample arrives
+        self.last = None  # last original sample (unixtime, samples)
+        self.t = None  # last sampling time
+        self.sampled = False  # whether any sampling time after the first sample was output
+
+    def push(self, unixtimeArr, dataArr):
+        """
+        Add the next chunk of original samples
+        :param unixtimeArr: np.array
+            ascending unixtimes, continuing the previous chunk
+        :param dataArr: np.array
+            (samples, columns) values
+        :return: newUnixtimeArr, newDataArr
+            resampled rows that are complete, none after the last unixtime of the chunk
+        """
+        unixtimeArr = np.asarray(unixtimeArr)
+        dataArr = np.asarray(dataArr)
+        if dataArr.ndim == 1:
+            dataArr = dataArr[:, None]
+        if len(unixtimeArr) == 0:
+            return self._empty(dataArr.shape[1])
+
+        self.count += len(unixtimeArr)
+        if self.last is None:
+            # always take the first timestamp time[0]
+            self.first = (unixtimeArr[0], dataArr[0])
+            self.t = unixtimeArr[0]
+        else:
+            # the last sample of the previous chunk is the left neighbor of the first sampling times
+            unixtimeArr = np.concatenate([[self.last[0]], unixtimeArr])
+            dataArr = np.concatenate([self.last[1][np.newaxis], dataArr])
+        self.last = (unixtimeArr[-1], dataArr[-1])
+
+        newUnixtimes = []
+        newData = []
+        if self.first is not None and self.count >= 2:
+            newUnixtimes.append([self.first[0]])
+            newData.append(np.asarray(self.first[1], dtype=float)[np.newaxis])
+            self.first = None
+
+        t = resample_grid(self.t, unixtimeArr[-1], self.deltaT, keepFirst=False)
+        if len(t):
+            newUnixtimes.append(t.astype(np.int64))
+            newData.append(interpolate_at(unixtimeArr, dataArr, t, self.gapTolerance, first_index=1))
+            self.t = t[-1]
+            self.sampled = True
+
+        if not newUnixtimes:
+            return self._empty(dataArr.shape[1])
+        return np.concatenate(newUnixtimes), np.concatenate(newData)
+
+    def finish(self):
+        """
+        End of the signal
+        :return: newUnixtimeArr, newDataArr
+            the sampling time after the first sample, as nan, when it is past the last unixtime
+        """
+        if self.count < 2 or self.sampled:
+            return self._empty(0 if self.last is None else len(self.last[1]))
+        self.sampled = True
+        return (np.array([self.t + self.deltaT]).astype(np.int64),
+                np.full((1, len(self.last[1])), np.nan))
+
+    @staticmethod
+    def _empty(columns):
+        return np.array([], dtype=np.int64), np.empty((0, columns))
+
+
+def interpolate(t1, s1, t2, s2, t):
+    """Interpolates at parameter 't' between points (t1,s1) and (t2,s2)
+    """
+
+    if (t1 <= t and t <= t2):  # we check if 't' is out of bounds (between t1 and t2)
+        m = float(s2 - s1) / (t2 - t1)
+        b = s1 - m * t1
+        return m * t + b
+    else:
+        return np.nan
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+
+"""
+Content-addressed cache of the minute mets of wrist uploads.
+An entry is keyed by the bytes of the uploaded files, the model version and the demographic info,
+so uploading the same accelerometer/gyroscope pair again returns the stored mets without running the pipeline.
+Entries are .npz files in CACHE_DIR, the least recently used ones are removed once the directory
+is larger than CACHE_MAX_BYTES.
+"""
+
+CACHE_DIR = "./cache"
+CACHE_MAX_BYTES = int(os.environ.get("WRIST_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+READ_SIZE = 1024 * 1024
+
+
+def copy_and_hash(source, destination):
+    """
+    Copy an uploaded file while hashing its bytes
+    :param source: file object
+        uploaded file, read to the end
+    :param destination: file object
+        opened for binary writing
+    :return: str
+        sha256 of the file bytes
+    """
+    digest = hashlib.sha256()
+    for block in iter(lambda: source.read(READ_SIZE), b''):
+        digest.update(block)
+        destination.write(block)
+    return digest.hexdigest()
+
+
+def cache_key(file_digests, model_version, demographics, mode='wrist'):
+    """
+    Key of a wrist result
+    :param file_digests: list
+        sha256 of each uploaded file, the order of the uploads does not matter
+    :param model_version: str
+        version of the model files, model_registry.model_version()
+    :param demographics: dict
+        demographic info used by the regression
+    :param mode: str
+        pipeline that computed the result, 'wrist' or 'accel' for the accelerometer only estimate
+    :return: str
+        hex key
+    """
+    key = {'files': sorted(file_digests), 'models': model_version, 'demographics': demographics}
+    if mode != 'wrist':  # keys of full results are unchanged
+        key['mode'] = mode
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def _path(key):
+    return os.path.join(CACHE_DIR, key + '.npz')
+
+
+def get(key):
+    """
+    Cached minute mets
+    :param key: str
+        key from cache_key
+    :return: dataframe
+        timestamp and mets columns, None on a miss
+    """
+    path = _path(key)
+    try:
+        with np.load(path) as entry:
+            result = pd.DataFrame({'timestamp': pd.to_datetime(entry['timestamp']), 'mets': entry['mets']})
+        os.utime(path)  # most recently used
+    except (OSError, KeyError, ValueError):
+        return None
+    return result
+
+
+def put(key, result):
+    """
+    Store minute mets and evict the least recently used entries over the size cap
+    :param key: str
+        key from cache_key
+    :param result: dataframe
+        timestamp and mets columns
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # write then rename, so a concurrent get never reads a partial entry
+    handle, temp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as temp:
+            np.savez(temp, timestamp=np.asarray(result['timestamp'], dtype='datetime64[ns]'),
+                     mets=np.asarray(result['mets'], dtype=float))
+        os.replace(temp_path, _path(key))
+    except OSError as e:
+        print("error writing result cache: {}".format(e))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return
+    evict()
+
+
+def evict(max_bytes=CACHE_MAX_BYTES):
+    """
+    Remove the least recently used entries until the cache fits in max_bytes
+    """
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.endswith('.npz'):
+            try:
+                stat = entry.stat()
+            except OSError:  # removed by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
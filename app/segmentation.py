@@ -0,0 +1,175 @@
+import numpy as np
+import pandas as pd
+
+
+def minute_starts(st, n_minutes):
+    """
+    Start time of each minute to examine
+    :param st: timestamp
+        start of the first minute
+    :param n_minutes: int
+        number of minutes
+    :return: DatetimeIndex
+        one start time per minute
+    """
+    return pd.date_range(st, periods=n_minutes, freq='min')
+
+
+def sort_by_datetime(df):
+    """
+    Make sure the Datetime column is in ascending order before segmenting
+    :param df: data frame
+        wrist data with a Datetime column
+    :return: data frame
+        df itself when already sorted, otherwise a copy sorted by Datetime
+        (e.g. local time repeating an hour at the end of daylight saving)
+    """
+    if df['Datetime'].is_monotonic_increasing:
+        return df
+    return df.sort_values('Datetime', kind='stable', ignore_index=True)
+
+
+def minute_bounds(df, st, n_minutes, window_size=60):
+    """
+    Row boundaries of each minute window, computed once from the sorted Datetime column
+    :param df: data frame
+        resampled wrist data with a Datetime column in ascending order
+    :param st: timestamp
+        start of the first minute
+    :param n_minutes: int
+        number of minutes
+    :param window_size: int
+        window length in seconds
+    :return: starts, ends: np.array
+        rows [starts[i], ends[i]) of df fall in minute i, same rows as the
+        (Datetime >= start) & (Datetime < end) mask
+    """
+    datetimes = pd.DatetimeIndex(df['Datetime'])
+    if not datetimes.is_monotonic_increasing:
+        raise ValueError('Datetime column must be sorted to segment minutes')
+    window_starts = minute_starts(st, n_minutes)
+    starts = datetimes.searchsorted(window_starts, side='left')
+    ends = datetimes.searchsorted(window_starts + pd.Timedelta(seconds=window_size), side='left')
+    return np.asarray(starts), np.asarray(ends)
+
+
+def stream_minutes(chunks):
+    """
+    Group consecutive chunks of samples into minutes, each minute is emitted as soon as it is complete
+    :param chunks: iterable
+        (datetimes, values) chunks in time order, values is a (samples, channels) array
+    :return: generator
+        (minute start, values of the minute)
+    """
+    pending_minute = None
+    pending = []
+    for datetimes, values in chunks:
+        if len(datetimes) == 0:
+            continue
+        minutes = pd.DatetimeIndex(datetimes).floor('min')
+        cuts = np.flatnonzero(minutes[1:] != minutes[:-1]) + 1
+        for start, end in zip(np.r_[0, cuts], np.r_[cuts, len(minutes)]):
+            if pending and minutes[start] != pending_minute:
+                yield pending_minute, np.concatenate(pending)
+                pending = []
+            pending_minute = minutes[start]
+            pending.append(values[start:end])
+    if pending:
+        yield pending_minute, np.concatenate(pending)
+
+
+def stack_minutes(minutes, window_starts, channels, dtype=float):
+    """
+    Concatenate the samples of the given minutes with their row boundaries, like minute_bounds on a data frame
+    :param minutes: dict
+        minute start -> (samples, channels) values
+    :param window_starts: list
+        minute starts to keep, a missing minute gets no rows
+    :param channels: int
+        number of channels
+    :param dtype: data type
+        data type of the values
+    :return: values, bounds
+        (rows, channels) values and the starts, ends rows of each minute
+    """
+    windows = [np.asarray(minutes.get(minute, np.empty((0, channels))), dtype=dtype) for minute in window_starts]
+    lengths = np.array([len(window) for window in windows], dtype=np.int64)
+    ends = np.cumsum(lengths)
+    values = np.concatenate(windows) if windows else np.empty((0, channels), dtype=dtype)
+    return values, (ends - lengths, ends)
+
+
+def minute_array(values, bounds, length=1200, fill=np.nan):
+    """
+    Minute windows as a single (minutes, length, channels) array
+    :param values: np.array
+        (rows, channels) samples the bounds were computed on
+    :param bounds: tuple
+        starts, ends from minute_bounds
+    :param length: int
+        samples per minute window, longer windows are cut and shorter ones padded,
+        None uses the longest window
+    :param fill: float
+        value used for padding
+    :return: np.array
+        (minutes, length, channels) windows, a reshaped view of values when
+        every window is exactly length samples long and the windows are contiguous
+    """
+    values = np.asarray(values)
+    starts, ends = bounds
+    if length is None:
+        length = int(np.max(ends - starts, initial=0))
+    n_minutes = len(starts)
+    if n_minutes and np.all(ends - starts == length) and np.all(starts == starts[0] + length * np.arange(n_minutes)):
+        return values[starts[0]:starts[0] + n_minutes * length].reshape(n_minutes, length, values.shape[1])
+
+    rows, covered = window_rows(bounds, length)
+    windows = np.full((n_minutes, length, values.shape[1]), fill, dtype=np.result_type(values, fill))
+    windows[covered] = values[rows[covered]]
+    return windows
+
+
+def window_rows(bounds, length):
+    """
+    Row of each sample of each minute window
+    :param bounds: tuple
+        starts, ends from minute_bounds
+    :param length: int
+        samples per minute window
+    :return: rows, covered: np.array
+        (minutes, length) row numbers and whether the sample is inside the minute
+    """
+    starts, ends = bounds
+    counts = np.minimum(ends - starts, length)
+    offsets = np.arange(length)
+    return starts[:, None] + offsets, offsets < counts[:, None]
+
+
+def assemble_windows(sources, length=1200, fill=0.0, dtype=np.float32):
+    """
+    Write the minute windows of several sensors into one pre-allocated (minutes, channels, length) array
+    :param sources: list
+        (values, bounds) per sensor, values is a (rows, channels) array and bounds come from minute_bounds
+        on the same rows, channels are stacked in the order given
+    :param length: int
+        samples per minute window, longer windows are cut and shorter ones padded
+    :param fill: float
+        value written where a minute has no sample
+    :param dtype: data type
+        data type of the array
+    :return: np.array
+        (minutes, channels, length) windows
+    """
+    n_minutes = len(sources[0][1][0])
+    n_channels = sum(np.shape(values)[1] for values, _ in sources)
+    windows = np.full((n_minutes, n_channels, length), fill, dtype=dtype)
+
+    channel = 0
+    for values, bounds in sources:
+        values = np.asarray(values)
+        rows, covered = window_rows(bounds, length)
+        # (minutes, length, channels) views, so samples are written straight into place
+        sensor_windows = windows[:, channel:channel + values.shape[1]].transpose(0, 2, 1)
+        sensor_windows[covered] = values[rows[covered]]
+        channel += values.shape[1]
+    return windows
@@ -1,216 +1,6 @@
 import numpy as np
 import pandas as pd
-
-def resample(dataDf, timeColHeader, samplingRate, gapTolerance=np.inf, fixedTimeColumn=None):
-    """
-    Parameters
-    ----------
-    dataDf : data dataframe, contains unixtime column and data column(s)
-
-    timeColHeader : string, time column header
-
-    samplingRate : int
-        Number of samples per second
-
-    gapTolerance: int(ms)
-        if the distance between target point and either of the neighbors is further than gapTolerance in millisecond,
-        then interpolation is nan
-        if gapTolerance=0, the gapTolerance rule will not exist
-
-    fixedTimeColumn:
-
-    Examples
-    --------
-    >>> timeColHeader = 'unixtime'
-    >>> df = pd.DataFrame(np.arange(20).reshape(5,4),
-                      columns=['unixtime', 'A', 'B', 'C'])
-
-    >>> unix = np.array([1500000000000,1500000000048,1500000000075,1500000000100,1500000000150])
-    >>> df['unixtime'] = unix
-    >>> print(df)
-            unixtime   A   B   C
-    0  1500000000000   1   2   3
-    1  1500000000048   5   6   7
-    2  1500000000075   9  10  11
-    3  1500000000100  13  14  15
-    4  1500000000150  17  18  19
-    >>> newSamplingRate = 20
-    >>> newDf = resample(df, timeColHeader, newSamplingRate)
-    >>> print(newDf)
-            unixtime          A          B          C
-    0  1500000000000   1.000000   2.000000   3.000000
-    1  1500000000050   5.296295   6.296295   7.296295
-    2  1500000000100  13.000000  14.000000  15.000000
-    3  1500000000150  17.000000  18.000000  19.000000
-
-    >>> newSamplingRate = 33
-    >>> newDf = resample(df, timeColHeader, newSamplingRate)
-    >>> print(newDf)
-            unixtime          A          B          C
-    0  1500000000000   1.000000   2.000000   3.000000
-    1  1500000000030   3.525238   4.525238   5.525238
-    2  1500000000060   6.867554   7.867554   8.867554
-    3  1500000000090  11.545441  12.545441  13.545441
-    4  1500000000121  14.696960  15.696960  16.696960
-
-    (Note: the 5th unixtime is 1500000000121 instead of 1500000000120, since 5th sampling is 121.21212121ms after 1st sampling.
-
-    development log:
-    1.
-    # always take the first timestamp time[0]
-    # if starttime == None:
-    newSignalList = [signalArr[0]]
-    newUnixtimeList = [unixtimeArr[0]]
-    # else:
-    #     newUnixtimeList = [starttime]
-        # if starttime >= signalArr[0]
-        # newSignalList = interpolate(unixtimeArr[tIndAfter-1], signalArr[tIndAfter-1], unixtimeArr[tIndAfter], signalArr[tIndAfter], t)
-
-    2.
-    # if gapTolerance == 0 or \
-    #     ((abs(unixtimeArr[tIndAfter-1]-t)<=gapTolerance) and \
-    #     (abs(unixtimeArr[tIndAfter]-t)<=gapTolerance)):
-
-    if gapTolerance == 0 or \
-        (abs(unixtimeArr[tIndAfter-1]-unixtimeArr[tIndAfter])<=gapTolerance):
-
-    -----
-    """
-
-    originalNameOrder = list(dataDf.columns.values)
-
-    unixtimeArr = dataDf[timeColHeader].values
-    deltaT = 1000.0 / samplingRate
-
-    dataDf = dataDf.drop(timeColHeader, axis=1)
-    dataArr = dataDf.values
-    names = list(dataDf.columns.values)
-
-    n = len(unixtimeArr)
-    newDataList = []
-
-    if n < 2:
-        return
-
-    if fixedTimeColumn is None:
-        # Looping through columns to apply the resampling method for each column
-        for c in range(dataArr.shape[1]):
-            signalArr = dataArr[:, c]
-
-            # always take the first timestamp time[0]
-            newSignalList = [signalArr[0]]
-            newUnixtimeList = [unixtimeArr[0]]
-
-            t = unixtimeArr[0] + deltaT
-            tIndAfter = 1
-
-            # iterate through the original signal
-            while True:
-                # look for the interval that contains 't'
-                i0 = tIndAfter
-                for i in range(i0, n):  # name indBefore/after
-                    if t <= unixtimeArr[i]:  # we found the needed time index
-                        tIndAfter = i
-                        break
-
-                # interpolate in the right interval, gapTolenance=0 means inf tol,
-                if gapTolerance == 0 or \
-                        (abs(unixtimeArr[tIndAfter - 1] - unixtimeArr[tIndAfter]) <= gapTolerance):
-                    s = interpolate(unixtimeArr[tIndAfter - 1], signalArr[tIndAfter - 1], \
-                                    unixtimeArr[tIndAfter], signalArr[tIndAfter], t)
-                else:
-                    s = np.nan
-
-                # apppend the new interpolated sample to the new signal and update the new time vector
-                newSignalList.append(s)
-                newUnixtimeList.append(int(t))
-                # take step further on time
-                t = t + deltaT
-                # check the stop condition
-                if t > unixtimeArr[-1]:
-                    break
-
-            newDataList.append(newSignalList)
-            newDataArr = np.transpose(np.array(newDataList))
-
-        dataDf = pd.DataFrame(data=newDataArr, columns=names)
-        dataDf[timeColHeader] = np.array(newUnixtimeList)
-
-        # change to the original column order
-        dataDf = dataDf[originalNameOrder]
-
-    else:  # if fixedTimeColumn not None:
-        # Looping through columns to apply the resampling method for each column
-        for c in range(dataArr.shape[1]):
-            signalArr = dataArr[:, c]
-            newSignalList = []
-            newUnixtimeList = []
-
-            iFixedTime = 0
-
-            t = fixedTimeColumn[iFixedTime]
-            tIndAfter = 0
-            outOfRange = 1
-
-            # iterate through the original signal
-            while True:
-                # look for the interval that contains 't'
-                i0 = tIndAfter
-                for i in range(i0, n):
-                    if t <= unixtimeArr[i]:  # we found the needed time index
-                        tIndAfter = i
-                        outOfRange = 0
-                        break
-
-                if outOfRange:
-                    s = np.nan
-                else:
-                    # interpolate in the right interval
-                    if tIndAfter == 0:  # means unixtimeArr[0] > t, there is no element smaller than t
-                        s = np.nan
-                    elif gapTolerance == 0 or \
-                            (abs(unixtimeArr[tIndAfter - 1] - unixtimeArr[tIndAfter]) <= gapTolerance):
-                        s = interpolate(unixtimeArr[tIndAfter - 1], signalArr[tIndAfter - 1], \
-                                        unixtimeArr[tIndAfter], signalArr[tIndAfter], t)
-                    else:
-                        s = np.nan
-
-                # apppend the new interpolated sample to the new signal and update the new time vector
-                newSignalList.append(s)
-                newUnixtimeList.append(int(t))
-
-                # check the stop condition
-                if t > unixtimeArr[-1]:
-                    break
-                # take step further on time
-                iFixedTime += 1
-
-                if iFixedTime >= len(fixedTimeColumn):
-                    break
-                t = fixedTimeColumn[iFixedTime]
-
-            newDataList.append(newSignalList)
-            newDataArr = np.transpose(np.array(newDataList))
-
-        dataDf = pd.DataFrame(data=newDataArr, columns=names)
-        dataDf[timeColHeader] = np.array(newUnixtimeList)
-
-        # change to the original column order
-        dataDf = dataDf[originalNameOrder]
-    return dataDf
-
-
-def interpolate(t1, s1, t2, s2, t):
-    """Interpolates at parameter 't' between points (t1,s1) and (t2,s2)
-    """
-
-    if (t1 <= t and t <= t2):  # we check if 't' is out of bounds (between t1 and t2)
-        m = float(s2 - s1) / (t2 - t1)
-        b = s1 - m * t1
-        return m * t + b
-    else:
-        return np.nan
-
+from resampling import resample, interpolate
 
 def get_intensity(watch_df, st):
     et = st + pd.DateOffset(minutes=1)
@@ -240,17 +30,61 @@ def get_intensity(watch_df, st):
         return np.nan
 
 
-def extract_features(gyro_data):
-    output = []
-    for m in gyro_data:
-        temp = []
-        for n in m:
-            for i in range(int(len(n) / 10)):
-                temp2 = np.array(n[i * 10:i * 10 + 10])
-                temp.append(np.mean(temp2))
-                temp.append(np.var(temp2))
-        output.append(temp)
-    return np.array(output)
+def get_intensity_batch(data):
+    """
+    K statistic of the acceleration for all minutes at once, same values as get_intensity on each minute
+    :param data: np.array
+        (minutes, samples, 3) accX, accY, accZ windows, samples with a nan accX (and padding) are skipped
+    :return: np.array
+        K of each minute, nan for a minute without samples
+    """
+    data = np.asarray(data, dtype=float)
+    valid = ~np.isnan(data[:, :, 0])
+    count = valid.sum(axis=1)
+    values = np.where(valid[:, :, np.newaxis], data, 0.0)
+    # accumulated sample after sample, so the sums round exactly like the loop in get_intensity
+    sums = np.add.accumulate(values, axis=1)[:, -1] if data.shape[1] else np.zeros((len(data), 3))
+    sums_sq = np.add.accumulate(values ** 2, axis=1)[:, -1] if data.shape[1] else np.zeros((len(data), 3))
+
+    Q = sums_sq[:, 0] + sums_sq[:, 1] + sums_sq[:, 2]
+    P = sums[:, 0] ** 2 + sums[:, 1] ** 2 + sums[:, 2] ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        K = ((Q - P / count) / (count - 1)) ** 0.5
+    K[count == 0] = np.nan
+    return K
+
+
+def extract_features(gyro_data, chunk_size=10):
+    """
+    Mean and variance of every 10 sample chunk of each channel, for all minutes at once
+    :param gyro_data: array like
+        (minutes, channels, samples) windows, e.g. np_training
+    :param chunk_size: int
+        samples per chunk
+    :return: np.array
+        one row per minute: [mean, var] of each chunk, chunk after chunk, channel after channel
+    """
+    try:
+        data = np.asarray(gyro_data, dtype=float)
+    except ValueError:  # channels of different length, reshape each one on its own
+        return np.array([np.concatenate([chunk_features(np.asarray(n, dtype=float), chunk_size).ravel() for n in m])
+                         for m in gyro_data])
+    return chunk_features(data, chunk_size).reshape(len(data), -1)
+
+
+def chunk_features(data, chunk_size=10):
+    """
+    Mean and variance of consecutive chunks along the last axis, a trailing partial chunk is dropped
+    :param data: np.array
+        (..., samples) signals
+    :param chunk_size: int
+        samples per chunk
+    :return: np.array
+        (..., chunks, 2) mean and variance of each chunk
+    """
+    n_chunks = data.shape[-1] // chunk_size
+    chunks = data[..., :n_chunks * chunk_size].reshape(data.shape[:-1] + (n_chunks, chunk_size))
+    return np.stack([chunks.mean(axis=-1), chunks.var(axis=-1)], axis=-1)
 
 
 def get_met_vm3(df_acti, st):
@@ -261,12 +95,44 @@ def get_met_vm3(df_acti, st):
     return met
 
 
-def actigraph_add_datetime(actigraph_data):
-    datetime = []
-    for i in range(len(actigraph_data['date'])):
-        date = pd.to_datetime(actigraph_data['date'][i], format='%m/%d/%Y').date()
-        time = pd.to_datetime(actigraph_data['epoch'][i], format='%I:%M:%S %p').time()
-        temp = pd.Timestamp.combine(date, time)
-        datetime.append(temp)
-    actigraph_data['Datetime'] = datetime
+def get_met_vm3_all(df_acti):
+    """
+    MET estimate of every ActiGraph epoch at once from the vector magnitude of the 3 axes
+    :param df_acti: data frame
+        actigraph data with axis1, axis2, axis3 columns
+    :return: np.array
+        met of each row, same values as get_met_vm3 on each row's Datetime
+    """
+    vm3 = (df_acti['axis1'].values ** 2 + df_acti['axis2'].values ** 2 + df_acti['axis3'].values ** 2) ** 0.5
+    return 0.000863 * vm3 + 0.668876
 
+
+def actigraph_add_datetime(actigraph_data, date_format='%m/%d/%Y', epoch_format='%I:%M:%S %p'):
+    """
+    Add a Datetime column combining the date and epoch columns of an ActiGraph export
+    Each distinct date and epoch string is parsed only once, in one call per column.
+    :param actigraph_data: data frame
+        actigraph data with date and epoch columns, Datetime is added in place
+    :param date_format: str
+        format of the date column
+    :param epoch_format: str
+        format of the epoch column
+    :return: index
+        rows whose date or epoch could not be parsed, their Datetime is NaT
+    """
+    date_codes, date_uniques = pd.factorize(actigraph_data['date'])
+    epoch_codes, epoch_uniques = pd.factorize(actigraph_data['epoch'])
+
+    dates = pd.to_datetime(pd.Series(date_uniques, dtype=object), format=date_format, errors='coerce').dt.normalize()
+    times = pd.to_datetime(pd.Series(epoch_uniques, dtype=object), format=epoch_format, errors='coerce')
+    time_of_day = times - times.dt.normalize()
+
+    # missing values get code -1, which picks the NaT appended at the end
+    dates = np.append(dates.values, np.datetime64('NaT'))
+    time_of_day = np.append(time_of_day.values, np.timedelta64('NaT'))
+    actigraph_data['Datetime'] = dates[date_codes] + time_of_day[epoch_codes]
+
+    failed = actigraph_data.index[actigraph_data['Datetime'].isna()]
+    if len(failed):
+        print("{} actigraph rows with unparsable date/epoch: {}".format(len(failed), list(failed[:10])))
+    return failed
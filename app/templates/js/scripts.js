@@ -54,9 +54,6 @@ $(document).ready(function() {
         });
         console.log(formdata)
 
-        updateTableInterval = setInterval(function() {
-            updateWrist()
-          }, 5000);
         $('#wrist-files').append('<div id="wrist_loading" class="ui active inverted dimmer"><div class="ui large text loader">Loading</div></div>')
        
         $.ajax({
@@ -67,6 +64,9 @@ $(document).ready(function() {
             processData: false,
             success: function(data, textStatus, jqXHR) {
                 console.log(data)
+                updateTableInterval = setInterval(function() {
+                    updateWristJob(data["job_id"])
+                  }, 2000);
             }
         });
     });   
@@ -92,17 +92,20 @@ function updateActi() {
     }
 }
 
-function updateWrist() {
-    var wrist_tbl = document.getElementById('wrist_met_table');
-    if (wrist_tbl.rows.length < 2) {
-        console.log("wrist table empty")
-        $("#wrist-div").load(window.location.href + " #wrist-div" );
-        return false;
-    } else {
-        console.log("wrist table not empty table")
-        removeWristLoader();    
-        clearInterval(updateTableInterval);
-    }
+function updateWristJob(job_id) {
+    // provisional mets show up first, the table is reloaded until the full result replaces them
+    $.get('/jobs/' + job_id + '/progress', function(job) {
+        console.log(job)
+        $("#wrist-div").load(window.location.href + " #wrist-div", function() {
+            if (document.getElementById('wrist_met_table').rows.length > 1) {
+                removeWristLoader();
+            }
+        });
+        if (job["status"] == "done" || job["status"] == "failed") {
+            removeWristLoader();
+            clearInterval(updateTableInterval);
+        }
+    });
 }
 
 function removeActiLoader(){
@@ -126,9 +129,12 @@ function plot_data(){
         type: 'POST',
         success: function(data, textStatus, jqXHR) {
             console.log(data)
-             $('#plotdiv1').html(data["plot1"]);
-             $('#plotdiv2').html(data["plot2"]);
-             $('#plotdiv3').html(data["plot3"]);
+            // the server sends traces and layouts only, plotly.js draws them here
+            $.each(['plot1', 'plot2', 'plot3'], function(i, name) {
+                var div = document.getElementById('plotdiv' + (i + 1));
+                $(div).empty();
+                Plotly.newPlot(div, data[name].data, data[name].layout, {responsive: true});
+            });
         }
     });
 }
@@ -6,219 +6,10 @@ from datetime import datetime, timedelta
 from sklearn import preprocessing
 import inspect
 import sys
+from resampling import resample, interpolate
 
 
 
-def resample(dataDf, timeColHeader, samplingRate, gapTolerance=np.inf, fixedTimeColumn=None):
-    """
-    Parameters
-    ----------
-    dataDf : data dataframe, contains unixtime column and data column(s)
-
-    timeColHeader : string, time column header
-
-    samplingRate : int
-        Number of samples per second
-
-    gapTolerance: int(ms)
-        if the distance between target point and either of the neighbors is further than gapTolerance in millisecond,
-        then interpolation is nan
-        if gapTolerance=0, the gapTolerance rule will not exist
-
-    fixedTimeColumn:
-
-    Examples
-    --------
-    >>> timeColHeader = 'unixtime'
-    >>> df = pd.DataFrame(np.arange(20).reshape(5,4),
-                      columns=['unixtime', 'A', 'B', 'C'])
-
-    >>> unix = np.array([1500000000000,1500000000048,1500000000075,1500000000100,1500000000150])
-    >>> df['unixtime'] = unix
-    >>> print(df)
-            unixtime   A   B   C
-    0  1500000000000   1   2   3
-    1  1500000000048   5   6   7
-    2  1500000000075   9  10  11
-    3  1500000000100  13  14  15
-    4  1500000000150  17  18  19
-    >>> newSamplingRate = 20
-    >>> newDf = resample(df, timeColHeader, newSamplingRate)
-    >>> print(newDf)
-            unixtime          A          B          C
-    0  1500000000000   1.000000   2.000000   3.000000
-    1  1500000000050   5.296295   6.296295   7.296295
-    2  1500000000100  13.000000  14.000000  15.000000
-    3  1500000000150  17.000000  18.000000  19.000000
-
-    >>> newSamplingRate = 33
-    >>> newDf = resample(df, timeColHeader, newSamplingRate)
-    >>> print(newDf)
-            unixtime          A          B          C
-    0  1500000000000   1.000000   2.000000   3.000000
-    1  1500000000030   3.525238   4.525238   5.525238
-    2  1500000000060   6.867554   7.867554   8.867554
-    3  1500000000090  11.545441  12.545441  13.545441
-    4  1500000000121  14.696960  15.696960  16.696960
-
-    (Note: the 5th unixtime is 1500000000121 instead of 1500000000120, since 5th sampling is 121.21212121ms after 1st sampling.
-    
-    development log:
-    1.
-    # always take the first timestamp time[0]
-    # if starttime == None:
-    newSignalList = [signalArr[0]]
-    newUnixtimeList = [unixtimeArr[0]]
-    # else:
-    #     newUnixtimeList = [starttime]
-        # if starttime >= signalArr[0]
-        # newSignalList = interpolate(unixtimeArr[tIndAfter-1], signalArr[tIndAfter-1], unixtimeArr[tIndAfter], signalArr[tIndAfter], t)
-    
-    2.
-    # if gapTolerance == 0 or \
-    #     ((abs(unixtimeArr[tIndAfter-1]-t)<=gapTolerance) and \
-    #     (abs(unixtimeArr[tIndAfter]-t)<=gapTolerance)):
-
-    if gapTolerance == 0 or \
-        (abs(unixtimeArr[tIndAfter-1]-unixtimeArr[tIndAfter])<=gapTolerance):
-
-    -----
-    """
-
-    originalNameOrder = list(dataDf.columns.values)
-
-    unixtimeArr = dataDf[timeColHeader].values
-    deltaT = 1000.0/samplingRate
-    
-    dataDf = dataDf.drop(timeColHeader, axis=1)
-    dataArr = dataDf.values
-    names = list(dataDf.columns.values)
-
-    n = len(unixtimeArr)
-    newDataList = []
-    
-    if n<2:
-        return
-
-    if fixedTimeColumn is None:
-        #Looping through columns to apply the resampling method for each column
-        for c in range(dataArr.shape[1]):
-            signalArr = dataArr[:,c]
-
-            # always take the first timestamp time[0]
-            newSignalList = [signalArr[0]]
-            newUnixtimeList = [unixtimeArr[0]]
-
-            t = unixtimeArr[0] + deltaT
-            tIndAfter = 1
-
-            # iterate through the original signal
-            while True:
-                # look for the interval that contains 't'
-                i0 = tIndAfter
-                for i in range(i0,n):# name indBefore/after
-                    if  t <= unixtimeArr[i]:#we found the needed time index
-                        tIndAfter = i
-                        break
-
-                # interpolate in the right interval, gapTolenance=0 means inf tol,
-                if gapTolerance == 0 or \
-                    (abs(unixtimeArr[tIndAfter-1]-unixtimeArr[tIndAfter])<=gapTolerance):
-                    s = interpolate(unixtimeArr[tIndAfter-1], signalArr[tIndAfter-1], \
-                                    unixtimeArr[tIndAfter], signalArr[tIndAfter], t)
-                else:
-                    s = np.nan
-
-                # apppend the new interpolated sample to the new signal and update the new time vector
-                newSignalList.append(s)
-                newUnixtimeList.append(int(t))
-                # take step further on time
-                t = t + deltaT
-                # check the stop condition
-                if t>unixtimeArr[-1]:
-                    break
-
-            newDataList.append(newSignalList)
-            newDataArr = np.transpose(np.array(newDataList))
-
-        dataDf = pd.DataFrame(data = newDataArr, columns = names)
-        dataDf[timeColHeader] = np.array(newUnixtimeList)
-
-        # change to the original column order
-        dataDf = dataDf[originalNameOrder]
-
-    else:  #if fixedTimeColumn not None:
-        #Looping through columns to apply the resampling method for each column
-        for c in range(dataArr.shape[1]):
-            signalArr = dataArr[:,c]
-            newSignalList = []
-            newUnixtimeList = []
-
-            iFixedTime = 0
-
-            t = fixedTimeColumn[iFixedTime]
-            tIndAfter = 0
-            outOfRange = 1
-
-            # iterate through the original signal
-            while True:
-                # look for the interval that contains 't'
-                i0 = tIndAfter
-                for i in range(i0,n):
-                    if  t <= unixtimeArr[i]:#we found the needed time index
-                        tIndAfter = i
-                        outOfRange = 0
-                        break
-
-                if outOfRange:
-                    s = np.nan
-                else:
-                    # interpolate in the right interval
-                    if tIndAfter == 0: # means unixtimeArr[0] > t, there is no element smaller than t
-                        s = np.nan
-                    elif gapTolerance == 0 or \
-                        (abs(unixtimeArr[tIndAfter-1] - unixtimeArr[tIndAfter]) <= gapTolerance):
-                        s = interpolate(unixtimeArr[tIndAfter-1], signalArr[tIndAfter-1], \
-                                        unixtimeArr[tIndAfter], signalArr[tIndAfter], t)
-                    else:
-                        s = np.nan
-
-                # apppend the new interpolated sample to the new signal and update the new time vector
-                newSignalList.append(s)
-                newUnixtimeList.append(int(t))
-
-                # check the stop condition
-                if t>unixtimeArr[-1]:
-                    break
-                # take step further on time
-                iFixedTime += 1
-
-                if iFixedTime>=len(fixedTimeColumn):
-                    break
-                t = fixedTimeColumn[iFixedTime]
-
-            newDataList.append(newSignalList)
-            newDataArr = np.transpose(np.array(newDataList))
-
-        dataDf = pd.DataFrame(data = newDataArr, columns = names)
-        dataDf[timeColHeader] = np.array(newUnixtimeList)
-
-        # change to the original column order
-        dataDf = dataDf[originalNameOrder]
-    return dataDf
-
-def interpolate(t1, s1, t2, s2, t):
-    """Interpolates at parameter 't' between points (t1,s1) and (t2,s2)
-    """
-
-    if(t1<=t and t<=t2): #we check if 't' is out of bounds (between t1 and t2)
-        m = float(s2 - s1)/(t2 - t1)
-        b = s1 - m*t1
-        return m*t + b
-    else:
-        return np.nan
-
-
 def clean_and_sort(df):
 
     df = df.apply(pd.to_numeric, errors='coerce')
@@ -229,25 +20,33 @@ def clean_and_sort(df):
 
     return df
 
-def organize(df, output_path, subj, sensor, location, resampled=False):
+def organize(df, output_path, subj, sensor, location, resampled=False, columnar=False):
+    """
+    Write the rows of each hour (US/Central) to its own folder, the rows are grouped by hour once
+    :param columnar: bool
+        write accel_data.npz with one array per sensor column instead of accel_data.csv
+    """
 
     if resampled:
         resample_folder = "Resampled"
     else:
         resample_folder = "Not Resampled"
 
+    columns = list(df.columns)
     df['DT'] = pd.to_datetime(pd.to_datetime(df['Time'], unit='ms', utc=True).dt.tz_convert('US/Central'))
 	#df['Month'] = df['DT'].dt.to_period('M')
 	#df['Day'] = df['DT'].dt.to_period('D')
 
     df['Hour'] = df['DT'].dt.to_period('H')
 
-    for date in df['Hour'].unique():
+    for date, df_hour in df.groupby('Hour', sort=False):
         path = os.path.join(output_path, subj, location, 'Wrist', 'Clean', resample_folder, sensor, '{}-{}-{}'.format(date.year,date.month,date.day), str(date.hour))
         if not os.path.exists(path):
             os.makedirs(path)
-        df_hour = df[df['Hour'] == date]
-        df_hour.to_csv(os.path.join(path, 'accel_data.csv'), index=False)
+        if columnar:
+            np.savez(os.path.join(path, 'accel_data.npz'), **{column: df_hour[column].values for column in columns})
+        else:
+            df_hour.to_csv(os.path.join(path, 'accel_data.csv'), index=False)
 
 def clean_and_resample(output_path, subjs, location):
     for subj in subjs:
@@ -336,6 +135,50 @@ def get_freq_intensity(df, fs, top, plot=False):
     else:
         return np.nan
 
+def compact_valid(data):
+    """
+    Move the samples without nan to the front of each minute, the array version of a dropna per minute
+    :param data: np.array
+        (minutes, samples, channels) windows, nan marks missing or padded samples
+    :return: compacted, lengths
+        (minutes, samples, channels) array with the valid samples of each minute first, in their
+        original order, and the number of valid samples of each minute
+    """
+    valid = ~np.isnan(data).any(axis=2)
+    lengths = valid.sum(axis=1)
+    if valid.all():
+        return data, lengths
+    order = np.argsort(~valid, axis=1, kind='stable')
+    return np.take_along_axis(data, order[:, :, None], axis=1), lengths
+
+def get_freq_intensity_batch(data, fs, top=1):
+    """
+    Dominant frequencies of the acceleration magnitude for all minutes at once
+    :param data: np.array
+        (minutes, samples, 3) accX, accY, accZ windows, nan samples are dropped
+    :param fs: int
+        sampling rate used for the frequency axis
+    :param top: int
+        number of dominant frequencies, the largest peak (0Hz) is skipped like in get_freq_intensity
+    :return: np.array
+        (minutes, top) frequencies by decreasing magnitude, column top-1 matches get_freq_intensity(df, fs, top)
+    """
+    data, lengths = compact_valid(np.asarray(data, dtype=float))
+    magnitude = np.sqrt(data[:, :, 0]**2 + data[:, :, 1]**2 + data[:, :, 2]**2)
+    result = np.full((len(data), top), np.nan)
+
+    # one rfft per signal length, the first sample is left out of the spectrum as in get_freq_intensity
+    signal_lengths = lengths - 1
+    for n in np.unique(signal_lengths):
+        if n // 2 <= top:  # not enough frequencies to rank
+            continue
+        rows = np.flatnonzero(signal_lengths == n)
+        Y = np.abs(np.fft.rfft(magnitude[rows, 1:n + 1], axis=1)[:, :n // 2] / n)
+        frq = np.arange(n // 2) / (n / fs)
+        ranked = np.argsort(-Y, axis=1, kind='stable')[:, 1:top + 1]
+        result[rows] = frq[ranked]
+    return result
+
 def get_rmssd(df, norm = 'l2'):
     df_temp = df.dropna()
     acc_x = list(df_temp['accX'])
@@ -355,7 +198,7 @@ def get_rmssd(df, norm = 'l2'):
             acc_y = processed[1]
             acc_z = processed[2]
         if(norm == 'minmax'):
-            scaler = MinMaxScaler()
+            scaler = preprocessing.MinMaxScaler()
             scaler.fit(data)
             processed = scaler.transform(data)
             acc_x = processed[0]
@@ -370,6 +213,44 @@ def get_rmssd(df, norm = 'l2'):
     else:
         return np.nan
     
+def get_rmssd_batch(data, norm = 'l2'):
+    """
+    RMSSD of the acceleration for all minutes at once
+    :param data: np.array
+        (minutes, samples, 3) accX, accY, accZ windows, nan samples are masked out
+    :param norm: str
+        'l1' or 'l2' normalizes each axis over the minute, 'minmax' scales each sample
+        across the 3 axes (MinMaxScaler fitted on the 3 x samples array), anything else uses raw values
+    :return: np.array
+        rmssd of each minute, same values as get_rmssd on each minute
+    """
+    data, lengths = compact_valid(np.asarray(data, dtype=float))
+    result = np.full(len(data), np.nan)
+
+    for n in np.unique(lengths):
+        if n == 0:
+            continue
+        rows = np.flatnonzero(lengths == n)
+        # (minutes, 3, n) so each minute is laid out like the 3 x n array of get_rmssd
+        x = np.ascontiguousarray(data[rows, :n].transpose(0, 2, 1))
+        if(norm == 'l2'):
+            norms = np.sqrt(np.einsum('mij,mij->mi', x, x))
+            x = x / np.where(norms == 0, 1, norms)[:, :, np.newaxis]
+        if(norm == 'l1'):
+            norms = np.abs(x).sum(axis=2)
+            x = x / np.where(norms == 0, 1, norms)[:, :, np.newaxis]
+        if(norm == 'minmax'):
+            data_min = x.min(axis=1, keepdims=True)
+            data_range = x.max(axis=1, keepdims=True) - data_min
+            scale = 1 / np.where(data_range < 10 * np.finfo(float).eps, 1, data_range)
+            x = x * scale + (0 - data_min * scale)
+
+        # squared successive differences summed in sample order, x then y then z
+        terms = (np.diff(x, axis=2) ** 2).transpose(0, 2, 1).reshape(len(rows), -1)
+        temp_sum = np.add.accumulate(terms, axis=1)[:, -1] if n > 1 else np.zeros(len(rows))
+        result[rows] = (temp_sum / n) ** (1/2)
+    return result
+
 def get_train_data(df, st, window_size, input_type='gyro'):
     et = st + pd.DateOffset(minutes=window_size/60)
     temp = df.loc[(df['Datetime'] >= st) & (df['Datetime'] < et)].reset_index(drop=True)
@@ -385,6 +266,17 @@ def get_train_data(df, st, window_size, input_type='gyro'):
 def extract_features(data):
     # Added new features: Median, mean, maximum, minimum, range, standard deviation, and root mean square power
 
+    data = np.asarray(data)
+    if data.ndim == 3 and data.dtype != object:
+        # all minutes at once, (minutes, channels, samples) -> 7 statistics x channels per minute
+        return np.concatenate([np.median(data, axis=2),
+                               np.mean(data, axis=2),
+                               np.max(data, axis=2),
+                               np.min(data, axis=2),
+                               np.max(data, axis=2) - np.min(data, axis=2),
+                               np.std(data, axis=2),
+                               np.sqrt(np.mean(data**2, axis=2))], axis=1)
+
     outcome = []
     for m in data:
         temp = []